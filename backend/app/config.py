@@ -48,7 +48,7 @@ class Settings(BaseSettings):
     REDIS_URL: str = os.getenv("REDIS_URL", "redis://redis:6379/0")
     REDIS_MAX_RETRY_COUNT: int = int(os.getenv("REDIS_MAX_RETRY_COUNT", "3"))
     REDIS_RETRY_INTERVAL: float = float(os.getenv("REDIS_RETRY_INTERVAL", "1.0"))
-    REDIS_MAX_CONNECTIONS: int = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+    REDIS_MAX_CONNECTIONS: int = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
     REDIS_SOCKET_TIMEOUT: float = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5.0"))
     REDIS_SOCKET_CONNECT_TIMEOUT: float = float(
         os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "2.0")
@@ -110,6 +110,10 @@ class Settings(BaseSettings):
         )
 
     MODEL_SERVICE_TIMEOUT: int = int(os.getenv("MODEL_SERVICE_TIMEOUT", "60"))  # 60秒
+    # 非流式生成时请求模型服务返回专家激活信息（trace=1），供MoE可视化使用
+    MODEL_SERVICE_TRACE_EXPERTS: bool = (
+        os.getenv("MODEL_SERVICE_TRACE_EXPERTS", "True").lower() == "true"
+    )
 
     # CORS配置
     BACKEND_CORS_ORIGINS: List[str] = []
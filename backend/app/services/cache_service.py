@@ -342,20 +342,19 @@ class CacheService:
             # 获取元数据以找到所有相关的缓存键
             metadata = await self.get_context_metadata(chat_id)
 
-            # 删除具体的上下文缓存
-            if metadata and "last_hash" in metadata:
-                context_key = f"context:{chat_id}:{metadata['last_hash']}"
-                await self.redis.delete(context_key)
+            # 元数据键
+            keys_to_delete = [f"context_meta:{chat_id}"]
 
-            # 删除元数据
-            metadata_key = f"context_meta:{chat_id}"
-            await self.redis.delete(metadata_key)
+            # 具体的上下文缓存
+            if metadata and "last_hash" in metadata:
+                keys_to_delete.append(f"context:{chat_id}:{metadata['last_hash']}")
 
-            # 使用模式匹配删除所有相关的上下文缓存
+            # 使用模式匹配找到所有相关的上下文缓存
             pattern = f"context:{chat_id}:*"
-            keys = await self.redis.keys(pattern)
-            if keys:
-                await self.redis.delete(*keys)
+            keys_to_delete.extend(await self.redis.keys(pattern))
+
+            # 一次性批量删除
+            await self.redis.delete_many(list(dict.fromkeys(keys_to_delete)))
 
             # 聊天上下文缓存已失效
         except Exception as e:
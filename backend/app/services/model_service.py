@@ -24,6 +24,7 @@ from app.utils.exceptions import (
     NotFoundException,
     ServiceUnavailableException,
 )
+from app.utils.expert_payload import encode_expert_counts
 from app.utils.logger import get_logger
 from app.utils.redis_client import RedisClient, get_redis
 from fastapi import Depends
@@ -283,9 +284,12 @@ class ModelService:
             if stop:
                 payload["stop"] = stop
 
+            # 模型服务默认不追踪专家激活，需要可视化数据时按请求开启
+            params = {"trace": "1"} if settings.MODEL_SERVICE_TRACE_EXPERTS else None
             response = await self.client.post(
                 f"{service_url}/v1/chat/completions",
                 json=payload,
+                params=params,
                 timeout=self.timeout,
             )
             response.raise_for_status()
@@ -766,11 +770,10 @@ class ModelService:
                     logger.warning("Redis客户端未初始化，无法发布专家激活数据")
                     return
 
-                # 将数据序列化为JSON
-                data_json = json.dumps(expert_stats)
-
-                # 发布到Redis频道
-                redis_client.publish("moe:expert:activation", data_json)
+                # 发布到Redis频道，消息体为按专家ID排列的int32激活次数
+                redis_client.publish(
+                    "moe:expert:activation", encode_expert_counts(expert_stats)
+                )
                 logger.info(f"已发布专家激活数据到Redis，专家数: {len(expert_stats)}")
             except Exception as e:
                 # 仅记录错误，不中断流程
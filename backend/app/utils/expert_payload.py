@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+专家激活数据编码模块
+
+将专家激活统计编码为Redis发布用的定长int32字节流
+"""
+
+import struct
+from typing import Dict
+
+
+def encode_expert_counts(expert_stats: Dict[str, int]) -> bytes:
+    """
+    按专家ID编码为小端int32数组的原始字节，订阅端可直接np.frombuffer还原
+
+    Args:
+        expert_stats: 专家激活统计，格式: {'专家ID': 激活次数}
+
+    Returns:
+        bytes: 下标即专家ID的激活次数数组，未出现的专家为0
+    """
+    counts = [0] * (max(map(int, expert_stats), default=-1) + 1)
+    for expert_id, count in expert_stats.items():
+        counts[int(expert_id)] = int(count)
+    return struct.pack(f"<{len(counts)}i", *counts)
@@ -7,6 +7,8 @@ Redis客户端模块
 """
 
 import asyncio
+import socket
+import time
 from datetime import datetime
 from typing import Any, AsyncGenerator, Dict, List, Optional, cast
 
@@ -18,14 +20,40 @@ from app.utils.exceptions import (
 )
 from app.utils.logger import get_logger
 from fastapi import Depends
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 
 logger = get_logger("app.redis")
 
 # Redis连接池
 _redis_pool: Optional[redis.ConnectionPool] = None
+# 同步Redis客户端，首次使用时创建，之后复用其连接池
+_sync_redis_client: Optional[Any] = None
 # 重连尝试次数与间隔从配置中读取
 MAX_RETRY_COUNT = settings.REDIS_MAX_RETRY_COUNT
 RETRY_INTERVAL = settings.REDIS_RETRY_INTERVAL
+# 单条命令遇到超时/连接错误时的重试次数
+COMMAND_RETRY_COUNT = 2
+
+
+def _build_keepalive_options() -> Dict[int, int]:
+    """
+    构建TCP keepalive参数
+
+    仅在支持相应socket选项的平台（如Linux）上生效，及时发现半开连接
+
+    Returns:
+        Dict[int, int]: socket选项到取值的映射
+    """
+    options: Dict[int, int] = {}
+    for name, value in (
+        ("TCP_KEEPIDLE", 30),
+        ("TCP_KEEPINTVL", 10),
+        ("TCP_KEEPCNT", 3),
+    ):
+        if hasattr(socket, name):
+            options[getattr(socket, name)] = value
+    return options
 
 
 async def init_redis_pool() -> redis.ConnectionPool:
@@ -50,7 +78,11 @@ async def init_redis_pool() -> redis.ConnectionPool:
                     socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
                     socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
                     socket_keepalive=True,  # 保持连接
+                    socket_keepalive_options=_build_keepalive_options(),
                     health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+                    # 瞬时超时/断连时在新连接上重试，避免整个请求失败
+                    retry_on_timeout=True,
+                    retry=Retry(ExponentialBackoff(), COMMAND_RETRY_COUNT),
                 )
 
                 # 测试连接
@@ -113,6 +145,15 @@ async def close_redis_pool() -> None:
 class RedisClient:
     """Redis客户端类，提供各种Redis操作的封装"""
 
+    # 最近一次ping成功的时间戳（单调时钟），在所有实例间共享
+    _last_ping_ok_ts: float = 0.0
+    # ping成功结果的缓存时间（秒），减少探针对Redis的压力
+    _ping_ttl: float = 2.0
+    # 最近一次内存检查的时间戳，INFO memory 无需在每次健康检查时执行
+    _last_mem_check_ts: float = 0.0
+    # 内存检查的最小间隔（秒）
+    _mem_check_interval: float = 30.0
+
     def __init__(self, redis_client: redis.Redis):
         """
         初始化Redis客户端
@@ -143,12 +184,19 @@ class RedisClient:
         Returns:
             bool: 连接是否正常
         """
+        now = time.monotonic()
+        if now - RedisClient._last_ping_ok_ts < self._ping_ttl:
+            return True
+
         try:
             ping_result = self.redis.ping()
             if hasattr(ping_result, "__await__"):
-                return cast(bool, await ping_result)
+                ok = cast(bool, await ping_result)
             else:
-                return cast(bool, ping_result)
+                ok = cast(bool, ping_result)
+            if ok:
+                RedisClient._last_ping_ok_ts = now
+            return ok
         except (redis.ConnectionError, redis.RedisError) as e:
             self.logger.error(f"Redis ping失败: {str(e)}")
             return False
@@ -271,6 +319,16 @@ class RedisClient:
         """
         try:
             prefixed_key = self._get_key(key)
+            # 优先使用UNLINK在后台线程释放内存，避免大键阻塞Redis
+            try:
+                result = self.redis.unlink(prefixed_key)
+                if hasattr(result, "__await__"):
+                    return cast(int, await result)
+                return cast(int, result)
+            except redis.ResponseError:
+                # 旧版本Redis不支持UNLINK，回退到DEL
+                pass
+
             result = self.redis.delete(prefixed_key)
             if hasattr(result, "__await__"):
                 final_result = cast(int, await result)
@@ -282,6 +340,39 @@ class RedisClient:
             self.logger.error(f"Redis删除键失败 [{key}]: {str(e)}")
             return 0
 
+    async def delete_many(self, keys: List[str]) -> int:
+        """
+        批量删除键
+
+        单条UNLINK命令删除所有键，避免逐个调用delete的多次往返
+
+        Args:
+            keys: 键名列表
+
+        Returns:
+            int: 删除的键数量
+        """
+        if not keys:
+            return 0
+        try:
+            prefixed_keys = [self._get_key(key) for key in keys]
+            try:
+                result = self.redis.unlink(*prefixed_keys)
+                if hasattr(result, "__await__"):
+                    return cast(int, await result)
+                return cast(int, result)
+            except redis.ResponseError:
+                # 旧版本Redis不支持UNLINK，回退到DEL
+                pass
+
+            result = self.redis.delete(*prefixed_keys)
+            if hasattr(result, "__await__"):
+                return cast(int, await result)
+            return cast(int, result)
+        except (redis.ConnectionError, redis.RedisError) as e:
+            self.logger.error(f"Redis批量删除键失败: {str(e)}")
+            return 0
+
     async def exists(self, key: str) -> bool:
         """
         检查键是否存在
@@ -322,9 +413,11 @@ class RedisClient:
             else:
                 keys = cast(List[str], result)
 
-            # 去除前缀返回原始键名
+            # 去除前缀返回原始键名（匹配模式已带前缀，返回的键必然以前缀开头）
             prefix_len = len(self.key_prefix)
-            return [key[prefix_len:] for key in keys if key.startswith(self.key_prefix)]
+            if settings.DEBUG:
+                assert all(key.startswith(self.key_prefix) for key in keys)
+            return [key[prefix_len:] for key in keys]
         except (redis.ConnectionError, redis.RedisError) as e:
             self.logger.error(f"Redis获取键列表失败 [{pattern}]: {str(e)}")
             return []
@@ -439,6 +532,54 @@ class RedisClient:
             self.logger.error(f"Redis设置哈希表字段值失败 [{name}:{key}]: {str(e)}")
             return 0
 
+    async def hset_mapping(self, name: str, mapping: Dict[str, Any]) -> int:
+        """
+        批量设置哈希表中的多个字段值
+
+        单条HSET命令写入所有字段，避免逐字段调用的多次往返
+
+        Args:
+            name: 哈希表名
+            mapping: 字段名到字段值的映射
+
+        Returns:
+            int: 新字段的数量
+        """
+        if not mapping:
+            return 0
+        try:
+            prefixed_name = self._get_key(name)
+            result = await self.redis.hset(  # type: ignore
+                prefixed_name, mapping=mapping
+            )
+            return cast(int, result)
+        except (redis.ConnectionError, redis.RedisError) as e:
+            self.logger.error(f"Redis批量设置哈希表字段值失败 [{name}]: {str(e)}")
+            return 0
+
+    async def hmget(self, name: str, keys: List[str]) -> List[Optional[str]]:
+        """
+        获取哈希表中指定字段的值
+
+        只需要部分字段时优先使用，避免hgetall传输整个哈希表
+
+        Args:
+            name: 哈希表名
+            keys: 字段名列表
+
+        Returns:
+            List[Optional[str]]: 与keys顺序对应的字段值，不存在的字段为None
+        """
+        if not keys:
+            return []
+        try:
+            prefixed_name = self._get_key(name)
+            result = await self.redis.hmget(prefixed_name, keys)  # type: ignore
+            return cast(List[Optional[str]], result)
+        except (redis.ConnectionError, redis.RedisError) as e:
+            self.logger.error(f"Redis批量获取哈希表字段值失败 [{name}]: {str(e)}")
+            return [None] * len(keys)
+
     async def hdel(self, name: str, *keys: str) -> int:
         """
         删除哈希表中的字段
@@ -597,8 +738,11 @@ class RedisClient:
             if not await self._check_read_write_operations():
                 return False
 
-            # 检查内存使用情况
-            await self._check_memory_usage()
+            # 检查内存使用情况（按间隔节流）
+            now = time.monotonic()
+            if now - RedisClient._last_mem_check_ts > self._mem_check_interval:
+                RedisClient._last_mem_check_ts = now
+                await self._check_memory_usage()
 
             return True
         except Exception as e:
@@ -631,13 +775,25 @@ def get_redis_sync() -> Any:
     Note:
         这个函数用于在需要同步Redis操作的地方使用，如后台任务
     """
+    global _sync_redis_client
+
+    if _sync_redis_client is not None:
+        return _sync_redis_client
+
     try:
         # 使用同步版本的redis库，而不是异步版本
         import redis
 
-        return cast(
-            redis.Redis, redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+        # 复用同一个连接池，避免每次发布都重新建立TCP连接
+        pool = redis.ConnectionPool.from_url(
+            settings.REDIS_URL,
+            decode_responses=True,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
         )
+        _sync_redis_client = cast(redis.Redis, redis.Redis(connection_pool=pool))
+        return _sync_redis_client
     except Exception as e:
         logger.error(f"同步Redis连接失败: {str(e)}")
         return None
@@ -8,7 +8,9 @@
 
 import base64
 import hashlib
+import os
 import secrets
+import threading
 import uuid
 from datetime import UTC, datetime, timedelta
 from typing import Any, Dict, Optional
@@ -22,6 +24,40 @@ ALGORITHM = "sha256"
 SALT_SIZE = 32
 ITERATIONS = 100000  # 推荐的迭代次数
 
+# 随机字节缓冲池，批量读取系统随机源以摊薄系统调用开销
+RANDOM_POOL_SIZE = 4096
+_random_pool = bytearray()
+_random_pool_lock = threading.Lock()
+
+
+def _reset_random_pool() -> None:
+    """清空随机字节缓冲池，防止fork出的子进程复用父进程的随机字节"""
+    global _random_pool_lock
+    _random_pool_lock = threading.Lock()
+    _random_pool.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_random_pool)
+
+
+def _draw_random_bytes(n: int) -> bytes:
+    """
+    从缓冲池中取出n个密码学安全的随机字节
+
+    Args:
+        n: 字节数
+
+    Returns:
+        bytes: 随机字节，每个字节只会被取出一次
+    """
+    with _random_pool_lock:
+        if len(_random_pool) < n:
+            _random_pool.extend(secrets.token_bytes(max(n, RANDOM_POOL_SIZE)))
+        out = bytes(_random_pool[:n])
+        del _random_pool[:n]
+    return out
+
 
 def get_password_hash(password: str) -> str:
     """
@@ -34,7 +70,7 @@ def get_password_hash(password: str) -> str:
         str: 哈希密码格式：算法$迭代次数$salt$hash
     """
     # 生成随机盐值
-    salt = secrets.token_bytes(SALT_SIZE)
+    salt = _draw_random_bytes(SALT_SIZE)
 
     # 使用PBKDF2算法哈希密码
     hash_bytes = hashlib.pbkdf2_hmac(
@@ -221,7 +257,8 @@ def generate_token() -> str:
     Returns:
         str: 随机令牌
     """
-    return secrets.token_urlsafe(32)
+    # 与secrets.token_urlsafe(32)格式一致：URL安全的base64且去掉填充
+    return base64.urlsafe_b64encode(_draw_random_bytes(32)).rstrip(b"=").decode("ascii")
 
 
 def decode_token(token: str) -> Optional[Dict[str, Any]]:
@@ -7,13 +7,133 @@ Token计算工具模块
 """
 
 import re
-from typing import Dict, List, Optional
+from functools import cache
+from typing import Any, Dict, List, Optional, Tuple
 
 from app.utils.logger import get_logger
 
+# 可选的加速依赖：有numba时使用编译内核，仅有numpy时使用向量化实现，
+# 都未安装时使用正则实现
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 # 获取日志记录器
 logger = get_logger(__name__)
 
+# 单条消息token数量缓存的最大条目数
+MESSAGE_TOKEN_CACHE_SIZE = 2048
+# 超过该长度的文本使用numpy/numba的字符分类实现
+LONG_TEXT_THRESHOLD = 256
+# 有上限计数时每次扫描的文本块长度
+BOUNDED_CHUNK_SIZE = 1024
+# 非中文字符的正则表达式，删除后剩余长度即为中文字符数
+_NON_CHINESE_RE = re.compile(r"[^\u4e00-\u9fff]+")
+# 单词与特殊符号合并为一个正则，一次扫描同时完成两类计数
+# 单词匹配返回单词本身，符号匹配返回空字符串
+_WORD_SYMBOL_RE = re.compile(r"(\w+)|[^\w\s]")
+# 纯ASCII文本使用ASCII语义的同一正则，结果相同但匹配更快
+_ASCII_WORD_SYMBOL_RE = re.compile(r"(\w+)|[^\w\s]", re.ASCII)
+# 非单词字符，用作分块扫描的安全切分点
+_NON_WORD_RE = re.compile(r"\W")
+# 基本多文种平面（BMP）的码位数量，查找表覆盖该范围
+BMP_SIZE = 0x10000
+
+
+def _build_char_tables() -> Tuple[Any, Any]:
+    """
+    构建BMP范围内的单词字符和空白字符查找表
+
+    与re模块对单词字符、空白字符的定义保持一致，保证与正则实现的计数结果相同
+
+    Returns:
+        Tuple[Any, Any]: (单词字符表, 空白字符表)，均为按码位索引的布尔数组
+    """
+    word_table = np.zeros(BMP_SIZE, dtype=np.bool_)
+    space_table = np.zeros(BMP_SIZE, dtype=np.bool_)
+    for code in range(BMP_SIZE):
+        char = chr(code)
+        if char.isalnum() or char == "_":
+            word_table[code] = True
+        elif char.isspace():
+            space_table[code] = True
+    return word_table, space_table
+
+
+if np is not None:
+    _WORD_TABLE, _SPACE_TABLE = _build_char_tables()
+
+if njit is not None:
+
+    @njit(cache=True)  # type: ignore[misc]
+    def _classify_codepoints(
+        codepoints: Any, word_table: Any, space_table: Any
+    ) -> Tuple[int, int, int]:
+        """单次遍历码位数组，统计中文字符数、单词数和特殊符号数"""
+        chinese = 0
+        words = 0
+        symbols = 0
+        in_word = False
+        for code in codepoints:
+            if word_table[code]:
+                if not in_word:
+                    words += 1
+                    in_word = True
+                if 0x4E00 <= code <= 0x9FFF:
+                    chinese += 1
+            else:
+                in_word = False
+                if not space_table[code]:
+                    symbols += 1
+        return chinese, words, symbols
+
+    # 导入时预编译，避免首个请求承担JIT编译开销
+    _classify_codepoints(np.zeros(1, dtype=np.uint32), _WORD_TABLE, _SPACE_TABLE)
+else:
+    _classify_codepoints = None
+
+
+def _classify_long_text(text: str) -> Optional[Tuple[int, int, int]]:
+    """
+    使用numba内核或numpy向量化运算统计长文本的中文字符数、单词数和特殊符号数
+
+    Args:
+        text: 输入文本
+
+    Returns:
+        Optional[Tuple[int, int, int]]: 统计结果；numpy不可用或文本含BMP以外字符时为None
+    """
+    if np is None:
+        return None
+    codepoints = np.frombuffer(
+        text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32
+    )
+    if codepoints.max() >= BMP_SIZE:
+        return None
+
+    if _classify_codepoints is not None:
+        chinese, words, symbols = _classify_codepoints(
+            codepoints, _WORD_TABLE, _SPACE_TABLE
+        )
+        return int(chinese), int(words), int(symbols)
+
+    is_word = _WORD_TABLE[codepoints]
+    chinese = np.count_nonzero((codepoints >= 0x4E00) & (codepoints <= 0x9FFF))
+    # 单词数即单词字符段的起点数
+    words = np.count_nonzero(is_word[1:] & ~is_word[:-1]) + int(is_word[0])
+    symbols = (
+        codepoints.size
+        - np.count_nonzero(is_word)
+        - np.count_nonzero(_SPACE_TABLE[codepoints])
+    )
+    return int(chinese), int(words), int(symbols)
+
 
 class TokenCounter:
     """
@@ -22,13 +142,16 @@ class TokenCounter:
     使用简单的启发式方法估算token数量，适用于中英文混合文本
     """
 
+    # 每条消息估算的格式化开销
+    _MESSAGE_OVERHEAD = 4
+
     def __init__(self) -> None:
-        # 中文字符的正则表达式
-        self.chinese_pattern = re.compile(r"[\u4e00-\u9fff]+")
-        # 英文单词的正则表达式
-        self.english_pattern = re.compile(r"\b\w+\b")
-        # 特殊符号和标点
-        self.symbol_pattern = re.compile(r"[^\w\s\u4e00-\u9fff]")
+        # 单条消息的token数量缓存，键为(role, content)
+        self._message_token_cache: Dict[Tuple[str, str], int] = {}
+        # 常见角色名的token数量固定，预先计算避免重复分词
+        self._role_tokens: Dict[str, int] = {
+            role: self.count_tokens(role) for role in ("system", "user", "assistant")
+        }
 
     def count_tokens(self, text: str) -> int:
         """
@@ -40,24 +163,124 @@ class TokenCounter:
         Returns:
             int: 估算的token数量
         """
-        if not text:
+        # 空文本和纯空白文本不含实际内容，无需扫描
+        if not text or text.isspace():
             return 0
 
+        # 最小值为1（非空文本）
+        return max(1, self._estimate_tokens(*self._classify(text)))
+
+    def count_tokens_bounded(self, text: str, limit: int) -> int:
+        """
+        估算文本的token数量，累计超过limit后提前停止扫描
+
+        Args:
+            text: 输入文本
+            limit: token数量上限
+
+        Returns:
+            int: 不超过limit时为准确的token数量，否则为某个大于limit的值
+        """
+        return self._count_prefix_tokens(text, limit)[0]
+
+    def _count_prefix_tokens(self, text: str, limit: int) -> Tuple[int, int]:
+        """
+        分块估算文本的token数量，累计超过limit时停止
+
+        只在非单词字符处分块，单词不会跨块，各块的分类计数直接相加即与整体一致
+
+        Args:
+            text: 输入文本
+            limit: token数量上限
+
+        Returns:
+            Tuple[int, int]: (token数量, 已扫描的字符数)
+        """
+        if not text or text.isspace():
+            return 0, len(text)
+
+        chinese = words = symbols = 0
+        tokens = 0
+        start = 0
+        length = len(text)
+        while start < length:
+            end = start + BOUNDED_CHUNK_SIZE
+            if end < length:
+                boundary = _NON_WORD_RE.search(text, end)
+                end = boundary.start() if boundary else length
+            else:
+                end = length
+
+            chunk_chinese, chunk_words, chunk_symbols = self._classify(text[start:end])
+            chinese += chunk_chinese
+            words += chunk_words
+            symbols += chunk_symbols
+            tokens = self._estimate_tokens(chinese, words, symbols)
+            start = end
+            if tokens > limit:
+                break
+
+        return max(1, tokens), start
+
+    @staticmethod
+    def _estimate_tokens(chinese: int, english_words: int, symbols: int) -> int:
+        """
+        根据分类计数估算token数量
+
+        Args:
+            chinese: 中文字符数
+            english_words: 单词数
+            symbols: 特殊符号数
+
+        Returns:
+            int: 估算的token数量
+        """
         # 中文字符：每个字符约1个token
-        chinese_tokens = sum(len(match) for match in self.chinese_pattern.findall(text))
+        chinese_tokens = chinese
 
         # 英文单词：平均每个单词约1.3个token
-        english_words = len(self.english_pattern.findall(text))
         english_tokens = int(english_words * 1.3)
 
         # 特殊符号：每个符号约0.5个token
-        symbols = len(self.symbol_pattern.findall(text))
         symbol_tokens = int(symbols * 0.5)
 
-        total_tokens = chinese_tokens + english_tokens + symbol_tokens
+        return chinese_tokens + english_tokens + symbol_tokens
 
-        # 最小值为1（非空文本）
-        return max(1, total_tokens)
+    def _classify(self, text: str) -> Tuple[int, int, int]:
+        """
+        统计文本的中文字符数、单词数和特殊符号数，长文本优先使用numpy/numba实现
+
+        Args:
+            text: 输入文本
+
+        Returns:
+            Tuple[int, int, int]: (中文字符数, 单词数, 特殊符号数)
+        """
+        if len(text) > LONG_TEXT_THRESHOLD:
+            counts = _classify_long_text(text)
+            if counts is not None:
+                return counts
+        return self._classify_text(text)
+
+    def _classify_text(self, text: str) -> Tuple[int, int, int]:
+        """
+        使用正则统计文本的中文字符数、单词数和特殊符号数
+
+        Args:
+            text: 输入文本
+
+        Returns:
+            Tuple[int, int, int]: (中文字符数, 单词数, 特殊符号数)
+        """
+        # 纯ASCII文本（代码、英文）不可能包含中文，跳过中文扫描
+        if text.isascii():
+            chinese = 0
+            words_and_symbols = _ASCII_WORD_SYMBOL_RE.findall(text)
+        else:
+            chinese = len(_NON_CHINESE_RE.sub("", text))
+            words_and_symbols = _WORD_SYMBOL_RE.findall(text)
+        symbols = words_and_symbols.count("")
+        return chinese, len(words_and_symbols) - symbols, symbols
 
     def count_messages_tokens(self, messages: List[Dict[str, str]]) -> int:
         """
@@ -69,20 +292,78 @@ class TokenCounter:
         Returns:
             int: 总token数量
         """
-        total_tokens = 0
+        # 循环内使用局部变量，避免每条消息重复查找属性
+        message_tokens = self._message_tokens
+        return sum(message_tokens(message) for message in messages)
 
-        for message in messages:
-            # 计算role的token（通常很少）
-            role_tokens = self.count_tokens(message.get("role", ""))
-            # 计算content的token
-            content_tokens = self.count_tokens(message.get("content", ""))
+    def _message_tokens(self, message: Dict[str, str]) -> int:
+        """
+        计算单条消息的token数量，结果按(role, content)缓存
+
+        截断过程中同一条消息会被多次计数，缓存后只需分词一次
 
-            # 每条消息还有一些格式化的开销
-            message_overhead = 4  # 估算的格式化开销
+        Args:
+            message: 消息，包含role和content字段
+
+        Returns:
+            int: 消息的token数量
+        """
+        role = message.get("role", "")
+        content = message.get("content", "")
+        key = (role, content)
+
+        cached = self._message_token_cache.get(key)
+        if cached is not None:
+            return cached
+
+        # 计算role的token（通常很少），常见角色直接查表
+        role_tokens = self._role_tokens.get(role)
+        if role_tokens is None:
+            role_tokens = self.count_tokens(role)
+        # 计算content的token，每条消息还有一些格式化的开销
+        message_tokens = (
+            role_tokens + self.count_tokens(content) + self._MESSAGE_OVERHEAD
+        )
+
+        self._cache_message_tokens(key, message_tokens)
+        return message_tokens
+
+    def _message_tokens_bounded(self, message: Dict[str, str], limit: int) -> int:
+        """
+        计算单条消息的token数量，超过limit后提前停止扫描content
 
-            total_tokens += role_tokens + content_tokens + message_overhead
+        Args:
+            message: 消息，包含role和content字段
+            limit: token数量上限
 
-        return total_tokens
+        Returns:
+            int: 不超过limit时为准确的token数量，否则为某个大于limit的值
+        """
+        role = message.get("role", "")
+        content = message.get("content", "")
+        key = (role, content)
+
+        cached = self._message_token_cache.get(key)
+        if cached is not None:
+            return cached
+
+        role_tokens = self._role_tokens.get(role)
+        if role_tokens is None:
+            role_tokens = self.count_tokens(role)
+        content_limit = limit - role_tokens - self._MESSAGE_OVERHEAD
+        content_tokens = self.count_tokens_bounded(content, max(content_limit, 0))
+        message_tokens = role_tokens + content_tokens + self._MESSAGE_OVERHEAD
+
+        # 只有完整扫描得到的准确值才写入缓存
+        if content_tokens <= content_limit:
+            self._cache_message_tokens(key, message_tokens)
+        return message_tokens
+
+    def _cache_message_tokens(self, key: Tuple[str, str], message_tokens: int) -> None:
+        """写入单条消息的token数量缓存，超过容量时整体清空"""
+        if len(self._message_token_cache) >= MESSAGE_TOKEN_CACHE_SIZE:
+            self._message_token_cache.clear()
+        self._message_token_cache[key] = message_tokens
 
     def truncate_messages_by_tokens(
         self,
@@ -105,6 +386,24 @@ class TokenCounter:
             return []
 
         system_messages, other_messages = self._separate_messages(messages)
+
+        # 快速路径：总量未超限且系统消息本就位于开头时，截断结果与原列表一致
+        system_count = len(system_messages) if preserve_system else 0
+        if len(system_messages) == system_count and all(
+            message.get("role") == "system" for message in messages[:system_count]
+        ):
+            # 按剩余额度有界计数，一旦超限即转入截断流程，不再扫描剩余消息
+            total_tokens = 0
+            for message in messages:
+                total_tokens += self._message_tokens_bounded(
+                    message, max_tokens - total_tokens
+                )
+                if total_tokens > max_tokens:
+                    break
+            else:
+                self._log_truncation_result(len(messages), len(messages), total_tokens)
+                return messages
+
         system_messages, system_tokens = self._process_system_messages(
             system_messages, max_tokens, preserve_system
         )
@@ -113,14 +412,16 @@ class TokenCounter:
         if remaining_tokens <= 0:
             return system_messages if preserve_system else []
 
-        selected_messages = self._select_messages_by_tokens(
+        selected_messages, selected_tokens = self._select_messages_by_tokens(
             other_messages, remaining_tokens
         )
 
         result = self._combine_messages(
             system_messages, selected_messages, preserve_system
         )
-        self._log_truncation_result(messages, result)
+        self._log_truncation_result(
+            len(messages), len(result), system_tokens + selected_tokens
+        )
         return result
 
     def _separate_messages(self, messages: List[Dict[str, str]]) -> tuple:
@@ -156,30 +457,31 @@ class TokenCounter:
         return system_messages, system_tokens
 
     def _select_messages_by_tokens(
-        self, messages: List[Dict[str, str]], max_tokens: int
-    ) -> List[Dict[str, str]]:
-        """根据token限制选择消息"""
-        selected_messages: List[Dict[str, str]] = []
-        current_tokens = 0
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+    ) -> Tuple[List[Dict[str, str]], int]:
+        """根据token限制选择消息，返回选中的消息及其token数量"""
+        if not messages:
+            return [], 0
 
-        # 反向遍历消息（从最新开始）
+        # 从最新消息开始按剩余额度有界计数，超限的消息只扫描到超出额度为止
+        remaining = max_tokens
+        keep_count = 0
         for message in reversed(messages):
-            message_tokens = self.count_messages_tokens([message])
-
-            if current_tokens + message_tokens <= max_tokens:
-                selected_messages.insert(0, message)
-                current_tokens += message_tokens
-            else:
-                # 如果单条消息就超过限制，尝试截断内容
-                if not selected_messages and message_tokens > max_tokens:
-                    truncated_message = self._truncate_single_message(
-                        message, max_tokens
-                    )
-                    if truncated_message:
-                        selected_messages.insert(0, truncated_message)
+            message_tokens = self._message_tokens_bounded(message, remaining)
+            if message_tokens > remaining:
                 break
-
-        return selected_messages
+            remaining -= message_tokens
+            keep_count += 1
+        if keep_count:
+            return messages[len(messages) - keep_count :], max_tokens - remaining
+
+        # 最新的单条消息就超过限制，尝试截断内容
+        truncated_message = self._truncate_single_message(messages[-1], max_tokens)
+        if not truncated_message:
+            return [], 0
+        return [truncated_message], self._message_tokens(truncated_message)
 
     def _combine_messages(
         self,
@@ -196,29 +498,29 @@ class TokenCounter:
 
     def _log_truncation_result(
         self,
-        original_messages: List[Dict[str, str]],
-        result_messages: List[Dict[str, str]],
+        original_count: int,
+        result_count: int,
+        result_tokens: int,
     ) -> None:
-        """记录截断结果"""
-        original_count = len(original_messages)
-        result_count = len(result_messages)
+        """
+        记录截断结果，token数量由调用方在截断过程中算好传入
 
+        被移除的消息只做了有界计数，不再为日志补算原始总量
+        """
         if result_count < original_count:
-            original_tokens = self.count_messages_tokens(original_messages)
-            result_tokens = self.count_messages_tokens(result_messages)
-
-            # 计算截断的消息数量和token数量
+            # 计算截断的消息数量
             truncated_messages = original_count - result_count
-            saved_tokens = original_tokens - result_tokens
 
+            # loguru使用{}占位符，参数延迟到日志级别通过后才格式化
             logger.info(
-                f"消息已截断: {original_count} -> {result_count} 条消息 "
-                f"({truncated_messages} 条被移除), "
-                f"Token数量: {original_tokens} -> {result_tokens} "
-                f"(节省 {saved_tokens} tokens)"
+                "消息已截断: {} -> {} 条消息 ({} 条被移除), 保留Token数量: {}",
+                original_count,
+                result_count,
+                truncated_messages,
+                result_tokens,
             )
         else:
-            logger.debug(f"消息未截断: 保留全部 {original_count} 条消息")
+            logger.debug("消息未截断: 保留全部 {} 条消息", original_count)
 
     def _truncate_single_message(
         self, message: Dict[str, str], max_tokens: int
@@ -242,14 +544,25 @@ class TokenCounter:
         if content_max_tokens <= 0:
             return None
 
-        # 简单的截断策略：按字符比例截断
-        current_tokens = self.count_tokens(content)
+        # 超过上限后不再扫描剩余内容，已扫描部分的前缀必然超限
+        current_tokens, scanned_length = self._count_prefix_tokens(
+            content, content_max_tokens
+        )
         if current_tokens <= content_max_tokens:
             return message
 
-        # 计算截断比例
-        truncate_ratio = content_max_tokens / current_tokens
-        truncate_length = int(len(content) * truncate_ratio * 0.9)  # 保守一点
+        # 前缀的token数量随长度单调不减，二分查找不超限的最长前缀
+        low, high = 0, scanned_length - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            prefix_tokens = self.count_tokens_bounded(
+                content[:middle], content_max_tokens
+            )
+            if prefix_tokens <= content_max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        truncate_length = low
 
         if truncate_length <= 0:
             return None
@@ -259,18 +572,12 @@ class TokenCounter:
         return {"role": message["role"], "content": truncated_content}
 
 
-# 全局token计数器实例
-_token_counter = None
-
-
+@cache
 def get_token_counter() -> TokenCounter:
     """
-    获取全局token计数器实例
+    获取全局token计数器实例，首次调用时创建，之后返回同一实例
 
     Returns:
         TokenCounter: token计数器实例
     """
-    global _token_counter
-    if _token_counter is None:
-        _token_counter = TokenCounter()
-    return _token_counter
+    return TokenCounter()
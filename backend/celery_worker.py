@@ -9,13 +9,10 @@ Celery Worker启动脚本
 from app.core.celery_app import celery_app
 
 if __name__ == "__main__":
-    # 执行Celery Worker
-    celery_app.worker_main(
-        argv=[
-            "worker",
-            "--loglevel=INFO",
-            "--concurrency=2",  # 进程数
-            "-Q",
-            "files,users,models,celery",  # 监听的队列
-        ]
+    # 直接构造Worker启动，跳过命令行参数解析
+    worker = celery_app.Worker(
+        loglevel="INFO",
+        concurrency=2,  # 进程数
+        queues=["files", "users", "models", "celery"],  # 监听的队列
     )
+    worker.start()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+专家激活数据编解码测试
+
+后端发布的字节流需能被可视化服务的np.frombuffer解码器原样还原
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+REPO_ROOT = BACKEND_DIR.parent
+sys.path[:0] = [str(BACKEND_DIR), str(REPO_ROOT)]
+
+from app.utils.expert_payload import encode_expert_counts  # noqa: E402
+
+# 解码器所在的可视化服务依赖numpy、redis和matplotlib
+pytest.importorskip("numpy")
+pytest.importorskip("redis")
+pytest.importorskip("matplotlib")
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+from moe_visualizer_service import decode_expert_counts  # noqa: E402
+
+
+def test_round_trip():
+    expert_stats = {"0": 520, "3": 12, "63": 1, "7": 2**31 - 1}
+    assert decode_expert_counts(encode_expert_counts(expert_stats)) == expert_stats
+
+
+def test_zero_counts_are_dropped():
+    payload = encode_expert_counts({"2": 0, "5": 4})
+    assert len(payload) == 6 * 4
+    assert decode_expert_counts(payload) == {"5": 4}
+
+
+def test_empty_stats():
+    assert encode_expert_counts({}) == b""
+    assert decode_expert_counts(b"") == {}
@@ -3,16 +3,34 @@ import argparse
 import os
 import time
 import uuid
+import numpy as np
 import torch
-import torch.nn.functional as F
-from typing import List, Optional, Literal, Generator, Union
+from typing import AsyncGenerator, List, Optional, Literal, Union
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from collections import defaultdict
-from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
+from collections import Counter, defaultdict, deque
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import islice
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, GenerationConfig, AsyncTextIteratorStreamer,
+    StoppingCriteria, StoppingCriteriaList
+)
+import asyncio
 import datetime
 import json
+import threading
+import types
+
+# 可选的融合MoE算子（sglang或vLLM），未安装时使用模型自带的逐专家实现
+try:
+    from sglang.srt.layers.moe.fused_moe_triton import fused_experts
+except ImportError:
+    try:
+        from vllm.model_executor.layers.fused_moe import fused_experts
+    except ImportError:
+        fused_experts = None
 
 # ========== 环境配置 ==========
 os.environ['DISABLE_MODELSCOPE_HUBUTILS'] = '1'
@@ -26,6 +44,13 @@ DEVICE = "cuda"
 DEVICE_ID = "0"
 CUDA_DEVICE = f"{DEVICE}:{DEVICE_ID}" if DEVICE_ID else DEVICE
 DEBUG_MODE = False
+MOE_KEYWORDS = ["moe", "expert", "gate", "router"]  # 诊断接口识别MoE模块的关键字
+TRACE_BY_DEFAULT = False  # 请求未指定trace参数时是否追踪专家激活
+CHAT_TEMPLATE_CACHE_SIZE = 1024  # 对话模板分词结果的缓存条目数
+ACTIVATION_RECORD_LIMIT = 4096  # 保留的专家激活记录上限，超出后丢弃最早的记录
+USE_FUSED_MOE = False  # 是否使用融合MoE算子替换逐专家的Python循环
+BATCH_MAX_SIZE = 8  # 单次generate合并的最大请求数
+BATCH_WAIT_SECONDS = 0.01  # 收集同批请求的最长等待时间
 
 # ========== FastAPI 初始化 ==========
 app = FastAPI(title="DeepSeek MoE API Server", version="2.0")
@@ -49,21 +74,95 @@ class LegacyRequest(BaseModel):
 # ========== 全局变量 ==========
 model = None
 tokenizer = None
-expert_activations = []
-hook_call_count = 0
+hook_call_count = 0  # 进程内追踪期间的hook调用总数，仅用于调试输出
+# 当前generate调用中各batch行的追踪状态：
+# (每行的RequestTrace或None, 每行左侧padding长度, 输入长度, 每行是否仍在生成或None)；
+# 在执行generate的线程中设置，未设置时（未追踪的请求、流式生成）hook直接返回
+generate_traces = ContextVar("generate_traces", default=None)
+last_expert_trace = None  # 最近一个完成的追踪请求，供/expert/info查询
 hooks = []
-
-# ========== GPU内存清理函数 ==========
-def torch_gc():
-    if torch.cuda.is_available():
-        with torch.cuda.device(CUDA_DEVICE):
-            torch.cuda.empty_cache()
-            torch.cuda.ipc_collect()
+module_index = {}  # 模块名 -> 模块类型名，加载模型时构建
+moe_module_names = []  # 名称包含MoE关键字的模块
+generate_queue = None  # 待批量生成的请求队列，启动时创建
+batch_worker_task = None
+
+# ========== 专家使用计数 ==========
+class RequestTrace:
+    """单个请求的专家激活记录，hook只写入属于该请求的token行"""
+
+    def __init__(self):
+        self.hook_call_count = 0
+        self.activations = deque(maxlen=ACTIVATION_RECORD_LIMIT)
+        self.usage_counters = {}  # 各设备上的专家使用计数
+
+def split_rows_by_request(binding, *tensors):
+    """把按(batch*seq)展开的张量拆回各追踪请求，预填充阶段去掉左侧padding行
+
+    解码阶段跳过已经生成结束符或用完自己max_tokens的行，这些行只是随同批其他请求继续填充
+
+    Yields:
+        (RequestTrace, 各张量属于该请求的行)
+    """
+    traces, pad_lengths, input_length, active_rows = binding
+    batch_size = len(traces)
+    num_rows = tensors[0].shape[0]
+    if num_rows % batch_size:
+        return
+    seq_len = num_rows // batch_size
+    decoding = seq_len != input_length
+    for row, (trace, pad_length) in enumerate(zip(traces, pad_lengths)):
+        if trace is None or (decoding and active_rows is not None and not active_rows[row]):
+            continue
+        # 解码阶段每行只有一个新token；预填充阶段跳过该行前面的padding
+        start = row * seq_len + (pad_length if seq_len == input_length else 0)
+        yield trace, [tensor[start:(row + 1) * seq_len] for tensor in tensors]
+
+class ActiveRowTracker(StoppingCriteria):
+    """合并生成时逐步标记各batch行是否仍在生成，本身从不停止generate
+
+    每步在新token追加后调用：行的最新token为结束符或已生成够该请求的max_tokens时，
+    该行之后的前向只是填充，hook据此不再计入
+    """
+
+    def __init__(self, max_tokens_list, input_length, eos_token_id):
+        self.max_tokens_list = max_tokens_list
+        self.input_length = input_length
+        self.eos_token_id = eos_token_id
+        self.active_rows = [True] * len(max_tokens_list)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.input_length
+        last_tokens = input_ids[:, -1].tolist()
+        for row, (token, max_tokens) in enumerate(zip(last_tokens, self.max_tokens_list)):
+            if token == self.eos_token_id or generated >= max_tokens:
+                self.active_rows[row] = False
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+def record_expert_usage(trace, expert_indices, num_experts):
+    """在专家索引所在设备上累加使用次数，避免逐个token同步到CPU"""
+    flat_indices = expert_indices.flatten()
+    expert_usage_counters = trace.usage_counters
+    counter = expert_usage_counters.get(flat_indices.device)
+    if counter is None or counter.numel() < num_experts:
+        new_counter = torch.zeros(
+            num_experts, dtype=torch.int64, device=flat_indices.device
+        )
+        if counter is not None:
+            new_counter[: counter.numel()] += counter
+        counter = new_counter
+        expert_usage_counters[flat_indices.device] = counter
+    counter.index_add_(0, flat_indices, torch.ones_like(flat_indices))
 
 # ========== Hook函数 - 保留原有的详细追踪逻辑 ==========
 def detailed_track_experts(module, input, output):
     """详细的专家激活追踪函数 - 专门针对DeepSeek MoE优化"""
     global hook_call_count
+
+    # 当前generate中没有追踪的请求时跳过全部处理，避免每次前向都进行检查和设备同步
+    binding = generate_traces.get()
+    if binding is None or not any(binding[0]):
+        return
+
     hook_call_count += 1
 
     try:
@@ -129,33 +228,37 @@ def detailed_track_experts(module, input, output):
             # 如果同时找到索引和权重，记录专家激活
             if expert_indices is not None and expert_weights is not None:
                 try:
-                    # 转换为Python列表以便后续处理
-                    indices_list = expert_indices.cpu().tolist()
-                    weights_list = expert_weights.cpu().tolist()
-
-                    expert_activations.append(
-                        {
-                            "module": module_name,
-                            "full_name": module_full_name,
-                            "hook_call": hook_call_count,
-                            "expert_indices": indices_list,
-                            "expert_weights": weights_list,
-                            "indices_shape": list(expert_indices.shape),
-                            "weights_shape": list(expert_weights.shape),
-                            "type": "moe_gate_output",
-                            "num_tokens": expert_indices.shape[0],
-                            "experts_per_token": expert_indices.shape[1],
-                        }
-                    )
+                    # 按请求拆分后在设备上累加专家使用次数，张量保留在设备上，查询时再转换
+                    for trace, (indices, weights) in split_rows_by_request(
+                        binding, expert_indices, expert_weights
+                    ):
+                        trace.hook_call_count += 1
+                        record_expert_usage(trace, indices, module.weight.shape[0])
+
+                        trace.activations.append(
+                            {
+                                "module": module_name,
+                                "full_name": module_full_name,
+                                "hook_call": trace.hook_call_count,
+                                # 只保存本请求行的专家索引副本，不引用整批的门控输出，
+                                # 权重未被读取，不再保留
+                                "expert_indices": indices.clone(),
+                                "indices_shape": list(indices.shape),
+                                "weights_shape": list(weights.shape),
+                                "type": "moe_gate_output",
+                                "num_tokens": indices.shape[0],
+                                "experts_per_token": indices.shape[1],
+                            }
+                        )
 
                     if should_log_detail:
                         print(f"🎉 成功记录MoE专家激活!")
                         print(f"   Token数量: {expert_indices.shape[0]}")
                         print(f"   每个token的专家数: {expert_indices.shape[1]}")
                         # 显示第一个token选择的专家
-                        if len(indices_list) > 0 and len(indices_list[0]) > 0:
-                            first_token_experts = indices_list[0]
-                            first_token_weights = weights_list[0]
+                        if expert_indices.numel() > 0:
+                            first_token_experts = expert_indices[0].tolist()
+                            first_token_weights = expert_weights[0].tolist()
                             print(f"   第一个token选择的专家: {first_token_experts}")
                             print(
                                 f"   对应权重: {[f'{w:.4f}' for w in first_token_weights]}"
@@ -175,29 +278,31 @@ def detailed_track_experts(module, input, output):
                         if 8 <= last_dim <= 256:  # 合理的专家数量范围
                             try:
                                 # 尝试作为router logits处理
-                                probs = F.softmax(item, dim=-1)
+                                # softmax单调，直接对logits取top-k，索引不变
                                 k = min(8, last_dim)
-                                top_k_result = torch.topk(probs, k=k, dim=-1)
-                                top_experts = top_k_result.indices.cpu().tolist()
-                                top_probs = top_k_result.values.cpu().tolist()
-
-                                expert_activations.append(
-                                    {
-                                        "module": module_name,
-                                        "full_name": module_full_name,
-                                        "hook_call": hook_call_count,
-                                        "expert_indices": top_experts,
-                                        "expert_probabilities": top_probs,
-                                        "logits_shape": list(item.shape),
-                                        "type": "router_logits",
-                                    }
-                                )
+                                top_experts = torch.topk(item, k=k, dim=-1).indices
+                                for trace, (experts,) in split_rows_by_request(
+                                    binding, top_experts.reshape(-1, k)
+                                ):
+                                    trace.hook_call_count += 1
+                                    record_expert_usage(trace, experts, last_dim)
+
+                                    trace.activations.append(
+                                        {
+                                            "module": module_name,
+                                            "full_name": module_full_name,
+                                            "hook_call": trace.hook_call_count,
+                                            "expert_indices": experts.clone(),
+                                            "logits_shape": [experts.shape[0], last_dim],
+                                            "type": "router_logits",
+                                        }
+                                    )
 
                                 if should_log_detail:
                                     print(
                                         f"🎯 发现Router Logits: 项{i}, shape={item.shape}"
                                     )
-                                    print(f"   Top专家: {top_experts}")
+                                    print(f"   Top专家: {top_experts.tolist()}")
 
                             except Exception as e:
                                 if should_log_detail and DEBUG_MODE:
@@ -210,6 +315,17 @@ def detailed_track_experts(module, input, output):
         if DEBUG_MODE:
             print(f"Hook #{hook_call_count} 处理错误: {e}")
 
+# ========== 模块索引 ==========
+def build_module_index(module_items):
+    """记录模型的模块名与类型，以及MoE相关模块名，供诊断接口直接查询"""
+    global module_index, moe_module_names
+    module_index = {name: type(module).__name__ for name, module in module_items}
+    moe_module_names = [
+        name
+        for name in module_index
+        if any(keyword in name.lower() for keyword in MOE_KEYWORDS)
+    ]
+
 # ========== Hook设置函数 - 保留原有逻辑 ==========
 def setup_expert_hooks(model):
     """为模型设置专家追踪hooks"""
@@ -225,45 +341,51 @@ def setup_expert_hooks(model):
     if DEBUG_MODE:
         print("🔍 分析模型结构...")
 
-    # 首先打印模型的基本结构
-    layer_types = {}
-    for name, module in model.named_modules():
-        module_type = type(module).__name__
-        if module_type not in layer_types:
-            layer_types[module_type] = []
-        layer_types[module_type].append(name)
+    # 只遍历一次模型，建立模块索引供后续查询复用，并为每个模块设置标识符
+    module_items = list(model.named_modules())
+    build_module_index(module_items)
+    for name, module in module_items:
+        module._module_name = name
 
+    # 首先打印模型的基本结构
     if DEBUG_MODE:
         print("📊 模型中的层类型:")
-        for layer_type, names in layer_types.items():
-            print(f"  {layer_type}: {len(names)}个")
-
-    # 策略1: 寻找DeepSeek MoE相关的层
-    moe_keywords = ["moe", "expert", "gate", "router", "ffn", "feed_forward"]
-
-    for name, module in model.named_modules():
-        module_name_lower = name.lower()
-        # 为每个模块设置一个标识符
-        module._module_name = name
+        for layer_type, count in Counter(module_index.values()).items():
+            print(f"  {layer_type}: {count}个")
 
-        # 检查是否是MoE相关层
-        if any(keyword in module_name_lower for keyword in moe_keywords):
+    # 优先按类型只hook MoEGate，专家选择结果都来自这一层，其他层的hook只会增加前向开销
+    for name, module in module_items:
+        if type(module).__name__ == "MoEGate":
             hook = module.register_forward_hook(detailed_track_experts)
             hooks.append(hook)
             hook_targets.append(name)
 
+    # 策略1: 没有MoEGate时，按名称寻找DeepSeek MoE相关的层
+    moe_keywords = ["moe", "expert", "gate", "router", "ffn", "feed_forward"]
+
+    if not hook_targets:
+        for name, module in module_items:
+            module_name_lower = name.lower()
+
+            # 检查是否是MoE相关层
+            if any(keyword in module_name_lower for keyword in moe_keywords):
+                hook = module.register_forward_hook(detailed_track_experts)
+                hooks.append(hook)
+                hook_targets.append(name)
+
     # 策略2: 如果策略1没找到足够的层，扩大搜索范围
-    if len(hook_targets) < 5:
-        if DEBUG_MODE:
-            print("🔧 策略1结果不足，扩大搜索范围...")
+    # 这些层大多不是MoE层，只在调试模式下用于分析模型结构
+    if DEBUG_MODE and len(hook_targets) < 5:
+        print("🔧 策略1结果不足，扩大搜索范围...")
+
+        hook_target_set = set(hook_targets)
 
         # 寻找可能包含FFN或MLP的层
         additional_keywords = ["mlp", "linear", "dense", "layer"]
 
-        for name, module in model.named_modules():
-            if name not in [target for target in hook_targets]:  # 避免重复
+        for name, module in module_items:
+            if name not in hook_target_set:  # 避免重复
                 module_name_lower = name.lower()
-                module._module_name = name
 
                 # 检查是否包含FFN相关的层
                 if any(keyword in module_name_lower for keyword in additional_keywords):
@@ -272,15 +394,19 @@ def setup_expert_hooks(model):
                         hook = module.register_forward_hook(detailed_track_experts)
                         hooks.append(hook)
                         hook_targets.append(name)
+                        hook_target_set.add(name)
 
     print(f"✅ 总共注册了 {len(hook_targets)} 个Hook")
     return len(hook_targets) > 0
 
 # ========== 专家统计函数 ==========
-def get_expert_info(max_records: int = 5):
-    """获取专家使用统计信息"""
+def get_expert_info(trace: Optional[RequestTrace] = None, max_records: int = 5):
+    """获取单个请求的专家使用统计信息，未指定时使用最近完成的追踪请求"""
+    if trace is None:
+        trace = last_expert_trace or RequestTrace()
+    expert_activations = trace.activations
     info = {
-        "total_hooks": hook_call_count,
+        "total_hooks": trace.hook_call_count,
         "activation_records": len(expert_activations),
         "details": [],
         "usage": {},
@@ -288,7 +414,7 @@ def get_expert_info(max_records: int = 5):
     }
 
     # 添加详细记录
-    for i, activation in enumerate(expert_activations[:max_records]):
+    for i, activation in enumerate(islice(expert_activations, max_records)):
         detail = {
             "module": activation["module"],
             "hook_call": activation["hook_call"],
@@ -297,30 +423,28 @@ def get_expert_info(max_records: int = 5):
         
         if "indices_shape" in activation:
             detail["shape"] = activation["indices_shape"]
-            detail["experts"] = activation["expert_indices"]
+            detail["experts"] = activation["expert_indices"].tolist()
         elif "logits_shape" in activation:
             detail["shape"] = activation["logits_shape"]
-            detail["experts"] = activation["expert_indices"]
+            detail["experts"] = activation["expert_indices"].tolist()
             
         info["details"].append(detail)
 
-    # 统计专家使用
-    expert_usage = defaultdict(int)
-    for activation in expert_activations:
-        experts = activation.get("expert_indices", [])
-        if isinstance(experts, list):
-            for batch in experts:
-                if isinstance(batch, list):
-                    for token_experts in batch:
-                        if isinstance(token_experts, list):
-                            for expert_id in token_experts:
-                                expert_usage[expert_id] += 1
-                        else:
-                            expert_usage[token_experts] += 1
-                else:
-                    expert_usage[batch] += 1
-
-    info["usage"] = dict(sorted(expert_usage.items(), key=lambda x: x[1], reverse=True))
+    # 统计专家使用：汇总各设备上的计数，只在这里同步到CPU
+    counts = np.zeros(0, dtype=np.int64)
+    for counter in trace.usage_counters.values():
+        device_counts = counter.cpu().numpy()
+        if device_counts.size > counts.size:
+            counts = np.pad(counts, (0, device_counts.size - counts.size))
+        counts[: device_counts.size] += device_counts
+
+    order = np.argsort(-counts, kind="stable")
+    expert_usage = {
+        int(expert_id): int(counts[expert_id])
+        for expert_id in order
+        if counts[expert_id] > 0
+    }
+    info["usage"] = expert_usage
     
     # 生成摘要
     if expert_usage:
@@ -331,11 +455,21 @@ def get_expert_info(max_records: int = 5):
 
     return info
 
-def reset_expert_tracking():
-    """重置专家追踪状态"""
-    global expert_activations, hook_call_count
-    expert_activations = []
-    hook_call_count = 0
+def parse_trace_param(value):
+    """解析trace查询参数，未指定时使用默认设置"""
+    if value is None:
+        return TRACE_BY_DEFAULT
+    return value.lower() in ("1", "true", "yes", "on")
+
+def validate_legacy_request(prompt, max_length):
+    """校验兼容接口的请求参数，合法时返回None，否则返回错误信息"""
+    if not isinstance(prompt, str):
+        return "prompt必须为字符串"
+    if max_length is not None and (
+        isinstance(max_length, bool) or not isinstance(max_length, int) or max_length < 1
+    ):
+        return "max_length必须为正整数"
+    return None
 
 # ========== 模型加载函数 ==========
 def load_model():
@@ -358,10 +492,22 @@ def load_model():
     # 加载并设置生成配置
     model.generation_config = GenerationConfig.from_pretrained(MODEL_PATH)
     model.generation_config.pad_token_id = model.generation_config.eos_token_id
+    model.config.use_cache = True
     model.eval()
 
+    # 批量生成时左侧填充，保证各序列的生成位置对齐
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+
     print("模型加载完成!")
 
+    if USE_FUSED_MOE:
+        if fused_experts is None:
+            print("⚠️ 未安装sglang或vLLM，继续使用逐专家的MoE实现")
+        else:
+            print(f"✅ 已为 {patch_fused_moe(model)} 个MoE层启用融合算子")
+
     # 设置专家追踪hooks
     hooks_setup = setup_expert_hooks(model)
     if hooks_setup:
@@ -369,60 +515,135 @@ def load_model():
     else:
         print("⚠️ 未找到MoE相关层，专家追踪可能无法正常工作")
 
+# ========== 融合MoE推理 ==========
+@torch.inference_mode()
+def fused_moe_infer(self, x, flat_expert_indices, flat_expert_weights):
+    """替换DeepseekMoE.moe_infer：一次融合算子完成所有专家的计算"""
+    top_k = self.num_experts_per_tok
+    return fused_experts(
+        hidden_states=x,
+        w1=self.fused_w1,
+        w2=self.fused_w2,
+        topk_weights=flat_expert_weights.view(-1, top_k).float(),
+        topk_ids=flat_expert_indices.view(-1, top_k).to(torch.int32),
+    )
+
+def patch_fused_moe(model):
+    """将各DeepseekMoE层的专家权重堆叠，并用融合算子替换moe_infer，返回替换的层数"""
+    patched = 0
+    for module in model.modules():
+        if type(module).__name__ != "DeepseekMoE":
+            continue
+        experts = module.experts
+        # 被卸载到CPU或磁盘的层保持原实现
+        if experts[0].gate_proj.weight.device.type != "cuda":
+            continue
+
+        # w1为[专家数, 2*中间维度, 隐藏维度]（gate在前、up在后），w2为[专家数, 隐藏维度, 中间维度]
+        w1 = torch.stack(
+            [torch.cat([e.gate_proj.weight, e.up_proj.weight], dim=0) for e in experts]
+        )
+        w2 = torch.stack([e.down_proj.weight for e in experts])
+
+        # 原专家权重改为堆叠张量的视图，显存中只保留一份
+        intermediate_size = experts[0].gate_proj.weight.shape[0]
+        for i, expert in enumerate(experts):
+            expert.gate_proj.weight.data = w1[i, :intermediate_size]
+            expert.up_proj.weight.data = w1[i, intermediate_size:]
+            expert.down_proj.weight.data = w2[i]
+
+        module.fused_w1 = w1
+        module.fused_w2 = w2
+        # 只替换专家计算部分，MoEGate照常执行，专家追踪hook不受影响
+        module.moe_infer = types.MethodType(fused_moe_infer, module)
+        patched += 1
+    return patched
+
 # ========== 推理函数 ==========
-def chat_generate(prompt_text, temperature=0.7, max_tokens=100, stream=False) -> Union[str, Generator]:
+@lru_cache(maxsize=CHAT_TEMPLATE_CACHE_SIZE)
+def encode_chat_prompt(prompt_text):
+    """套用对话模板并分词，结果按提示文本缓存；返回元组，避免缓存内容被修改"""
+    return tuple(
+        tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt_text}], add_generation_prompt=True
+        )
+    )
+
+def to_model_device(tensor):
+    """将输入张量放到模型所在设备，CUDA下经锁页内存异步拷贝"""
+    if model.device.type == "cuda":
+        return tensor.pin_memory().to(model.device, non_blocking=True)
+    return tensor.to(model.device)
+
+def chat_generate(prompt_text, temperature=0.7, max_tokens=100, stream=False) -> Union[str, AsyncGenerator]:
     """生成聊天回复"""
     if stream:
-        def token_stream():
+        async def token_stream():
             # 构建输入
-            messages = [{"role": "user", "content": prompt_text}]
-            input_tensor = tokenizer.apply_chat_template(
-                messages, add_generation_prompt=True, return_tensors="pt"
-            )
+            input_tensor = torch.tensor([await asyncio.to_thread(encode_chat_prompt, prompt_text)])
             
             # 生成响应ID
             response_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
             created_time = int(time.time())
             
-            # 流式生成
-            with torch.no_grad():
-                # 这里需要实现真正的流式生成
-                # 由于transformers的generate方法不直接支持流式，我们先生成完整结果然后模拟流式
-                generated = model.generate(
-                    input_tensor.to(model.device),
-                    max_new_tokens=max_tokens,
-                    temperature=temperature,
-                    do_sample=True,
-                    pad_token_id=tokenizer.pad_token_id,
-                    eos_token_id=tokenizer.eos_token_id,
-                    use_cache=True
-                )
-            
-            new_tokens = generated[:, input_tensor.shape[1]:]
-            result = tokenizer.decode(new_tokens[0], skip_special_tokens=True)
-            
-            # 将结果分成单词进行流式输出
-            words = result.split()
-            
-            for i, word in enumerate(words):
-                chunk_data = {
-                    "id": response_id,
-                    "object": "chat.completion.chunk",
-                    "created": created_time,
-                    "model": "deepseek-moe-16b-chat",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "delta": {
-                                "content": word + " "
-                            },
-                            "finish_reason": None
-                        }
-                    ]
-                }
-                yield f"data: {json.dumps(chunk_data)}\n\n"
-                time.sleep(0.05)  # 模拟流式延迟
-            
+            # 在后台线程中生成，streamer在每个token解码后通过事件循环返回对应文本，
+            # 等待期间不占用事件循环和线程池
+            streamer = AsyncTextIteratorStreamer(
+                tokenizer, skip_prompt=True, skip_special_tokens=True
+            )
+            generate_kwargs = dict(
+                input_ids=to_model_device(input_tensor),
+                attention_mask=to_model_device(torch.ones_like(input_tensor)),
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                do_sample=True,
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                use_cache=True,
+                streamer=streamer,
+            )
+
+            def run_generate():
+                # inference_mode是线程局部的，需要在生成线程内设置
+                try:
+                    with torch.inference_mode():
+                        model.generate(**generate_kwargs)
+                except Exception as e:
+                    # 生成失败时结束streamer，避免流式响应一直等待
+                    print(f"流式生成时发生错误: {e}")
+                    streamer.end()
+
+            thread = threading.Thread(target=run_generate, daemon=True)
+            thread.start()
+
+            # 除content外每个chunk都相同，预先序列化一次，之后只需序列化文本本身
+            chunk_template = {
+                "id": response_id,
+                "object": "chat.completion.chunk",
+                "created": created_time,
+                "model": "deepseek-moe-16b-chat",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {
+                            "content": "\0"
+                        },
+                        "finish_reason": None
+                    }
+                ]
+            }
+            chunk_prefix, chunk_suffix = f"data: {json.dumps(chunk_template)}\n\n".split(
+                json.dumps("\0")
+            )
+
+            # 逐段输出生成的文本
+            async for text in streamer:
+                if not text:
+                    continue
+                yield chunk_prefix + json.dumps(text) + chunk_suffix
+
+            await asyncio.to_thread(thread.join)
+
             # 发送结束标记
             final_chunk = {
                 "id": response_id,
@@ -443,14 +664,15 @@ def chat_generate(prompt_text, temperature=0.7, max_tokens=100, stream=False) ->
         return token_stream()
         
     # 非流式生成
-    messages = [{"role": "user", "content": prompt_text}]
-    input_tensor = tokenizer.apply_chat_template(
-        messages, add_generation_prompt=True, return_tensors="pt"
-    )
+    input_tensor = torch.tensor([encode_chat_prompt(prompt_text)])
     
-    with torch.no_grad():
+    input_ids = to_model_device(input_tensor)
+    attention_mask = to_model_device(torch.ones_like(input_tensor))
+
+    with torch.inference_mode():
         outputs = model.generate(
-            input_tensor.to(model.device),
+            input_ids,
+            attention_mask=attention_mask,
             max_new_tokens=max_tokens,
             temperature=temperature,
             do_sample=True,
@@ -464,18 +686,147 @@ def chat_generate(prompt_text, temperature=0.7, max_tokens=100, stream=False) ->
     )
     return result
 
+# ========== 批量生成 ==========
+def resolve_max_tokens(max_tokens, prompt_length):
+    """max_tokens为None时按generation_config的默认值换算为该请求的新token数"""
+    if max_tokens is not None:
+        return max_tokens
+    generation_config = model.generation_config
+    if generation_config.max_new_tokens is not None:
+        return generation_config.max_new_tokens
+    # 只配置了max_length时，它包含输入长度；都未配置时generate默认max_length为20
+    max_length = generation_config.max_length or 20
+    return max(max_length - prompt_length, 1)
+
+def batch_generate(prompt_ids_list, temperature, max_tokens_list, traces):
+    """将多个请求合并为一次generate调用，返回各请求的(回复, 输入token数, 生成token数)
+
+    prompt_ids_list为各请求已分词的输入，max_tokens_list为已换算好的生成上限；
+    逐请求的校验和分词都在入队前完成，单个异常请求不会连累同批的其他请求。
+    traces为各请求的RequestTrace（不追踪时为None），hook只把对应batch行记入其中
+    """
+    input_ids = [list(ids) for ids in prompt_ids_list]
+    inputs = tokenizer.pad({"input_ids": input_ids}, padding=True, return_tensors="pt")
+    input_length = inputs["input_ids"].shape[1]
+
+    input_tensor = to_model_device(inputs["input_ids"])
+    attention_mask = to_model_device(inputs["attention_mask"])
+
+    # 有追踪的请求时逐步记录各行是否已结束，避免已结束的行继续计入专家激活
+    stopping_criteria = StoppingCriteriaList()
+    active_rows = None
+    if any(traces):
+        tracker = ActiveRowTracker(max_tokens_list, input_length, tokenizer.eos_token_id)
+        stopping_criteria.append(tracker)
+        active_rows = tracker.active_rows
+
+    # tokenizer为左侧padding，每行前面的padding长度即与最长输入的差
+    token = generate_traces.set(
+        (traces, [input_length - len(ids) for ids in input_ids], input_length, active_rows)
+    )
+    try:
+        with torch.inference_mode():
+            outputs = model.generate(
+                input_tensor,
+                attention_mask=attention_mask,
+                stopping_criteria=stopping_criteria,
+                max_new_tokens=max(max_tokens_list),
+                temperature=temperature,
+                do_sample=True,
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                use_cache=True
+            )
+    finally:
+        generate_traces.reset(token)
+
+    # 按各请求自己的max_tokens截取新生成的token，结束符之后的填充不计入生成token数
+    results = []
+    for ids, output, max_tokens in zip(input_ids, outputs, max_tokens_list):
+        new_tokens = output[input_length:input_length + max_tokens]
+        eos_positions = (new_tokens == tokenizer.eos_token_id).nonzero()
+        completion_tokens = (
+            int(eos_positions[0]) + 1 if len(eos_positions) else len(new_tokens)
+        )
+        results.append(
+            (
+                tokenizer.decode(new_tokens, skip_special_tokens=True),
+                len(ids),
+                completion_tokens,
+            )
+        )
+    return results
+
+async def batch_worker():
+    """从队列收集请求，按temperature分组后批量生成"""
+    while True:
+        batch = [await generate_queue.get()]
+        deadline = time.monotonic() + BATCH_WAIT_SECONDS
+        while len(batch) < BATCH_MAX_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(generate_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # 采样参数不同的请求不能放在同一次generate中
+        groups = defaultdict(list)
+        for item in batch:
+            groups[item[1]].append(item)
+
+        for temperature, items in groups.items():
+            try:
+                results = await asyncio.to_thread(
+                    batch_generate,
+                    [item[0] for item in items],
+                    temperature,
+                    [item[2] for item in items],
+                    [item[4] for item in items],
+                )
+                for item, result in zip(items, results):
+                    if not item[3].done():
+                        item[3].set_result(result)
+            except Exception as e:
+                for item in items:
+                    if not item[3].done():
+                        item[3].set_exception(e)
+
+async def submit_generate(prompt_text, temperature=0.7, max_tokens=100, trace=None):
+    """提交生成请求并等待批量生成的结果；trace为RequestTrace时记录该请求的专家激活
+
+    分词和max_tokens换算在这里完成，出错时只影响本请求，队列中只放token id和生成上限
+    """
+    global last_expert_trace
+    # 未命中缓存时分词较慢，放到线程中执行，不阻塞事件循环
+    prompt_ids = await asyncio.to_thread(encode_chat_prompt, prompt_text)
+    max_tokens = resolve_max_tokens(max_tokens, len(prompt_ids))
+    future = asyncio.get_running_loop().create_future()
+    await generate_queue.put((prompt_ids, temperature, max_tokens, future, trace))
+    result = await future
+    if trace is not None:
+        last_expert_trace = trace
+    return result
+
 # ========== 启动事件 ==========
 @app.on_event("startup")
 def startup_event():
     load_model()
 
+@app.on_event("startup")
+async def start_batch_worker():
+    global generate_queue, batch_worker_task
+    generate_queue = asyncio.Queue()
+    batch_worker_task = asyncio.create_task(batch_worker())
+
 # ========== API端点 ==========
 
 # 1. OpenAI标准API
 @app.post("/v1/chat/completions")
-def chat_completions(req: ChatRequest):
-    reset_expert_tracking()
-    
+async def chat_completions(req: ChatRequest, trace: Optional[str] = None):
+    trace = parse_trace_param(trace)
+
     # 构建对话文本
     messages = [m.dict() for m in req.messages]
     if len(messages) > 0:
@@ -487,12 +838,15 @@ def chat_completions(req: ChatRequest):
         stream = chat_generate(prompt, req.temperature, req.max_tokens, stream=True)
         return StreamingResponse(stream, media_type="text/event-stream")
     
-    result = chat_generate(prompt, req.temperature, req.max_tokens)
+    # 只有请求trace时才追踪专家激活，追踪状态只属于本请求
+    request_trace = RequestTrace() if trace else None
+    result, prompt_tokens, completion_tokens = await submit_generate(
+        prompt, req.temperature, req.max_tokens, request_trace
+    )
     response_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
     print(f'响应：{result}')
-    print(get_expert_info())
 
-    return {
+    response = {
         "id": response_id,
         "object": "chat.completion",
         "created": int(time.time()),
@@ -508,29 +862,40 @@ def chat_completions(req: ChatRequest):
             }
         ],
         "usage": {
-            "prompt_tokens": len(tokenizer.encode(prompt)),
-            "completion_tokens": len(tokenizer.encode(result)),
-            "total_tokens": len(tokenizer.encode(prompt)) + len(tokenizer.encode(result))
-        },
-        "expert_info": get_expert_info()
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
     }
+    if trace:
+        response["expert_info"] = get_expert_info(request_trace)
+        print(response["expert_info"])
+    return response
 
 # 2. 兼容原有API格式
 @app.post("/")
 async def legacy_endpoint(request: Request):
     """保持与原api6(3).py兼容的端点"""
     try:
-        json_post_raw = await request.json()
-        json_post = json.dumps(json_post_raw)
-        json_post_list = json.loads(json_post)
+        json_post_list = await request.json()
         prompt = json_post_list.get("prompt")
         max_length = json_post_list.get("max_length", 512)
+        # 入队前校验，格式错误的请求直接返回400，不进入批量生成
+        error = validate_legacy_request(prompt, max_length)
+        if error is not None:
+            return JSONResponse(status_code=400, content={
+                "response": error,
+                "status": 400,
+                "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            })
 
-        # 重置专家追踪状态
-        reset_expert_tracking()
+        trace = parse_trace_param(request.query_params.get("trace"))
 
-        # 生成回复
-        result = chat_generate(prompt, max_tokens=max_length)
+        # 生成回复，只有请求trace时才追踪专家激活
+        request_trace = RequestTrace() if trace else None
+        result, _, _ = await submit_generate(
+            prompt, max_tokens=max_length, trace=request_trace
+        )
 
         now = datetime.datetime.now()
         time_str = now.strftime("%Y-%m-%d %H:%M:%S")
@@ -540,8 +905,9 @@ async def legacy_endpoint(request: Request):
             "response": result,
             "status": 200,
             "time": time_str,
-            "expert_info": get_expert_info()  # 添加专家信息
         }
+        if trace:
+            answer["expert_info"] = get_expert_info(request_trace)  # 添加专家信息
 
         # 构建日志信息
         log = (
@@ -555,7 +921,6 @@ async def legacy_endpoint(request: Request):
             + '"'
         )
         print(log)
-        torch_gc()
 
         return answer
 
@@ -591,21 +956,15 @@ def get_model_structure():
     if model is None:
         return {"error": "模型未加载"}
     
-    total_modules = 0
-    moe_related = []
-    
-    for name, module in model.named_modules():
-        total_modules += 1
-        if any(k in name.lower() for k in ['moe', 'expert', 'gate', 'router']):
-            moe_related.append({
-                "name": name,
-                "type": type(module).__name__
-            })
-    
+    # 直接使用加载模型时建立的模块索引
+    moe_related = [
+        {"name": name, "type": module_index[name]} for name in moe_module_names[:20]
+    ]
+
     return {
-        "total_modules": total_modules,
-        "moe_related_count": len(moe_related),
-        "moe_modules": moe_related[:20],  # 只返回前20个
+        "total_modules": len(module_index),
+        "moe_related_count": len(moe_module_names),
+        "moe_modules": moe_related,  # 只返回前20个
         "hooks_registered": len(hooks)
     }
 
@@ -646,7 +1005,7 @@ async def list_models():
 
 # ========== 命令行启动入口 ==========
 def main():
-    global DEBUG_MODE
+    global DEBUG_MODE, TRACE_BY_DEFAULT, USE_FUSED_MOE
     import uvicorn
 
     # 命令行参数解析
@@ -654,15 +1013,20 @@ def main():
     parser.add_argument("--debug", action="store_true", help="启用调试模式")
     parser.add_argument("--port", type=int, default=6006, help="设置运行端口，默认为6006")
     parser.add_argument("--host", type=str, default="0.0.0.0", help="设置绑定地址，默认为0.0.0.0")
+    parser.add_argument("--trace", action="store_true", help="默认对每个请求追踪专家激活")
+    parser.add_argument("--fused-moe", action="store_true", help="使用sglang/vLLM的融合MoE算子")
     args = parser.parse_args()
 
     DEBUG_MODE = args.debug
+    TRACE_BY_DEFAULT = args.trace
+    USE_FUSED_MOE = args.fused_moe
     port = args.port
     host = args.host
 
     print("🚀 启动 DeepSeek MoE API Server")
     print(f"📍 地址: http://{host}:{port}")
     print(f"🔧 调试模式: {'开启' if DEBUG_MODE else '关闭'}")
+    print(f"🔍 默认专家追踪: {'开启' if TRACE_BY_DEFAULT else '关闭（可通过?trace=1按请求开启）'}")
     print(f"📊 支持端点:")
     print(f"   - POST /v1/chat/completions (OpenAI标准)")
     print(f"   - POST / (兼容原API)")
@@ -670,7 +1034,8 @@ def main():
     print(f"   - GET /expert/info (专家信息)")
     print(f"   - GET /debug/model_structure (模型结构)")
 
-    uvicorn.run("moe_server:app", host=host, port=port, workers=1, reload=False)
+    # 直接传入app对象，使上面设置的全局参数对服务生效
+    uvicorn.run(app, host=host, port=port, workers=1, reload=False)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,16 +3,29 @@ from typing import Union  # 用于类型注解兼容
 import argparse  # 新增：用于解析命令行参数
 
 import os
+import queue
+import re
+import importlib.util
 import time
 import uuid
 import torch
-import torch.nn.functional as F
+import numpy as np
 from typing import List, Optional, Literal, Generator
 from fastapi import FastAPI
 from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from pydantic import BaseModel
-from collections import defaultdict
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from collections import OrderedDict, defaultdict
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache, partial
+import threading
+from threading import Thread
+from transformers import (
+    AutoModelForCausalLM, AutoTokenizer, DynamicCache, StoppingCriteria, StoppingCriteriaList,
+    TextIteratorStreamer
+)
 
 # ========== 环境配置 ==========
 os.environ['DISABLE_MODELSCOPE_HUBUTILS'] = '1'
@@ -24,9 +37,45 @@ os.environ['LOCAL_RANK'] = '0'
 MODEL_PATH = "/mnt/nvme/qwen/Qwen1___5-MoE-A2___7B-Chat"
 device = "cuda" if torch.cuda.is_available() else "cpu"
 DEBUG_MODE = False  # 是否启用详细调试输出
+COMPILE_MODEL = False  # 是否用torch.compile逐层编译Transformer块
+QUANTIZE = None  # 权重量化方式：None / "4bit" / "8bit"（需安装bitsandbytes）
+TRACE_EXPERTS = False  # 是否注册hook追踪专家激活
+EXPERT_BUF_TOKENS = 8192  # 专家激活缓冲区每层保留的token数
+MAX_EXPERT_RECORDS = 5  # 返回details的hook调用条数
+BATCH_MAX_SIZE = 8  # 单次generate合并的最大请求数
+BATCH_WAIT_SECONDS = 0.005  # 收集同批请求的最长等待时间
+MAX_IN_FLIGHT = 1  # 同时在GPU上执行的generate调用数
+CHAT_TEMPLATE_CACHE_SIZE = 1024  # 对话模板分词结果的LRU缓存条数
+PREFIX_CACHE_MAX_BYTES = 0  # 前缀KV缓存最多占用的显存字节数，默认0表示关闭
+STREAM_TOKEN_TIMEOUT = 120  # 流式生成等待下一段文本的最长秒数，超时视为生成线程失败
+
+# Hook目标模块名匹配规则，按优先级依次回退
+MOE_MODULE_RE = re.compile(r"moe|expert|router|gate", re.IGNORECASE)
+MLP_MODULE_RE = re.compile(r"mlp", re.IGNORECASE)
+LAYER_MODULE_RE = re.compile(r"layer|block|transformer", re.IGNORECASE)
 
 # ========== FastAPI 初始化 ==========
-app = FastAPI()
+def report_load_result(task):
+    global model_load_error
+    if not task.cancelled() and task.exception() is not None:
+        # 记录失败原因，/health据此区分加载失败与仍在加载
+        model_load_error = f"{type(task.exception()).__name__}: {task.exception()}"
+        print(f"❌ 模型加载失败: {task.exception()}")
+
+@asynccontextmanager
+async def lifespan(app):
+    """模型在后台线程中加载，服务立即开始监听，加载期间/health返回loading"""
+    global generate_queue, batch_worker_task
+    generate_queue = asyncio.Queue()
+    batch_worker_task = asyncio.create_task(batch_worker())
+    load_task = asyncio.create_task(asyncio.to_thread(load_model))
+    load_task.add_done_callback(report_load_result)
+    yield
+    batch_worker_task.cancel()
+    if not load_task.done():
+        print("⚠️ 模型尚未加载完成，服务已关闭")
+
+app = FastAPI(lifespan=lifespan)
 
 # ========== 请求结构定义 ==========
 class ChatMessage(BaseModel):
@@ -43,152 +92,359 @@ class ChatRequest(BaseModel):
 # ========== 全局变量 ==========
 model = None
 tokenizer = None
-expert_activations = []
-hook_call_count = 0
+model_ready = False  # 模型加载及预热全部完成后置为True
+model_load_error = None  # 后台加载失败时的错误信息
+expert_layer_count = 0  # 注册了专家追踪hook的层数，注册hook时设置
+router_logit_dims = (60, 64, 8, 4)  # 视为路由logits的输出末维，识别出路由模块后改为专家数
+expert_buf_pool = []  # 空闲的专家激活缓冲区，请求结束后归还复用
+# 当前generate调用中各batch行的追踪状态：
+# (每行的ExpertTrace, 每行左侧padding长度, 输入长度, 每行是否仍在生成或None)；
+# hook在generate所在线程中读取，未设置时（如流式生成）不记录
+expert_traces = ContextVar("expert_traces", default=None)
+prefix_cache = OrderedDict()  # prompt token元组 -> (预填充后的DynamicCache, 字节数)，按LRU淘汰
+prefix_cache_trie = {}  # token -> 子节点；节点的None键存放以该位置结尾的缓存key，查找最长前缀用
+prefix_cache_bytes = 0
+prefix_cache_lock = threading.Lock()
+gpu_semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+generate_queue = None  # 待批量生成的请求队列，启动时创建
+batch_worker_task = None
 
 # ========== Hook 函数 ==========
-def detailed_track_experts(module, input, output):
-    global hook_call_count, expert_activations
-    hook_call_count += 1
+class ExpertTrace:
+    """单个请求的专家激活记录，合并生成时只记录该请求所在batch行
+
+    buf为[token位置, hook层, top-4专家]的环形缓冲区，从池中取用，release后归还
+    """
+
+    def __init__(self):
+        self.hook_call_count = 0
+        self.activation_count = 0  # 成功记录专家激活的hook调用次数
+        self.layer_cursors = [0] * expert_layer_count  # 每层已写入的token数，取模得到行号
+        self.records = []  # 前几次hook调用的元信息，用于返回details
+        self.buf = expert_buf_pool.pop() if expert_buf_pool else torch.zeros(
+            (EXPERT_BUF_TOKENS, expert_layer_count, 4), dtype=torch.int16, device=device
+        )
+
+    def release(self):
+        expert_buf_pool.append(self.buf)
+        self.buf = None
+
+    def write_rows(self, layer_idx, top_experts):
+        """把一次前向的top-k专家写入该层的环形缓冲区，超出容量时覆盖最早的行"""
+        n = top_experts.shape[0]
+        if n > EXPERT_BUF_TOKENS:
+            self.layer_cursors[layer_idx] += n - EXPERT_BUF_TOKENS
+            top_experts = top_experts[-EXPERT_BUF_TOKENS:]
+            n = EXPERT_BUF_TOKENS
+        start = self.layer_cursors[layer_idx] % EXPERT_BUF_TOKENS
+        first = min(n, EXPERT_BUF_TOKENS - start)
+        self.buf[start:start + first, layer_idx].copy_(top_experts[:first], non_blocking=True)
+        if first < n:
+            self.buf[:n - first, layer_idx].copy_(top_experts[first:], non_blocking=True)
+        self.layer_cursors[layer_idx] += n
+        return start
+
+def split_rows_by_request(binding, rows):
+    """把按(batch*seq)展开的行拆回各请求，预填充阶段去掉左侧padding行
+
+    解码阶段跳过已经生成结束符或用完自己max_tokens的行，这些行只是随同批其他请求继续填充
+
+    Yields:
+        (ExpertTrace, 属于该请求的行)
+    """
+    traces, pad_lengths, input_length, active_rows = binding
+    batch_size = len(traces)
+    if rows.shape[0] % batch_size:
+        return
+    seq_len = rows.shape[0] // batch_size
+    decoding = seq_len != input_length
+    for row, (trace, pad_length) in enumerate(zip(traces, pad_lengths)):
+        if decoding and active_rows is not None and not active_rows[row]:
+            continue
+        # 解码阶段每行只有一个新token；预填充阶段跳过该行前面的padding
+        start = row * seq_len + (pad_length if seq_len == input_length else 0)
+        yield trace, rows[start:(row + 1) * seq_len]
+
+class ActiveRowTracker(StoppingCriteria):
+    """合并生成时逐步标记各batch行是否仍在生成，本身从不停止generate
+
+    每步在新token追加后调用：行的最新token为结束符或已生成够该请求的max_tokens时，
+    该行之后的前向只是填充，hook据此不再写入
+    """
+
+    def __init__(self, max_tokens_list, input_length, eos_token_id):
+        self.max_tokens_list = max_tokens_list
+        self.input_length = input_length
+        self.eos_token_id = eos_token_id
+        self.active_rows = [True] * len(max_tokens_list)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.input_length
+        last_tokens = input_ids[:, -1].tolist()
+        for row, (token, max_tokens) in enumerate(zip(last_tokens, self.max_tokens_list)):
+            if token == self.eos_token_id or generated >= max_tokens:
+                self.active_rows[row] = False
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+def detailed_track_experts(module, input, output, layer_idx=0):
+    binding = expert_traces.get()
+    if binding is None:
+        return
+    traces = binding[0]
+    for trace in traces:
+        trace.hook_call_count += 1
     router_logits = None
 
     if isinstance(output, tuple):
         for item in output:
-            if hasattr(item, 'shape') and item.shape[-1] in [60, 64, 8, 4]:
+            if hasattr(item, 'shape') and item.shape[-1] in router_logit_dims:
                 router_logits = item
-    elif hasattr(output, 'shape') and output.shape[-1] in [60, 64, 8, 4]:
+    elif hasattr(output, 'shape') and output.shape[-1] in router_logit_dims:
         router_logits = output
     if DEBUG_MODE:
-        print(f"Hook调用 #{hook_call_count}: {type(module).__name__}")
+        print(f"Hook调用 #{traces[0].hook_call_count}: {type(module).__name__}")
 
     if router_logits is not None:
         if router_logits.dim() == 1:
             router_logits = router_logits.unsqueeze(0).unsqueeze(0)
         elif router_logits.dim() == 2:
             router_logits = router_logits.unsqueeze(1)
-        probs = F.softmax(router_logits, dim=-1)
-        top_experts = torch.topk(probs, k=4, dim=-1).indices.cpu().tolist()
-        expert_activations.append({
-            'module': type(module).__name__,
-            'hook_call': hook_call_count,
-            'experts': top_experts,
-            'shape': router_logits.shape
-        })
+        # softmax单调，直接对logits取top-k；结果留在设备上写入预分配缓冲区，
+        # 前向过程中不做CPU同步，也不产生逐token的Python对象
+        top_experts = torch.topk(router_logits.detach(), k=4, dim=-1).indices
+        for trace, rows in split_rows_by_request(binding, top_experts.reshape(-1, 4)):
+            start = trace.write_rows(layer_idx, rows)
+            trace.activation_count += 1
+            if len(trace.records) < MAX_EXPERT_RECORDS:
+                # 合并生成时只记录本请求的行数
+                shape = list(router_logits.shape) if len(traces) == 1 else [rows.shape[0], 1, router_logits.shape[-1]]
+                trace.records.append({
+                    'module': type(module).__name__,
+                    'hook_call': trace.hook_call_count,
+                    'shape': shape,
+                    'layer': layer_idx,
+                    'start': start,
+                })
         if DEBUG_MODE:
-            print(f"  ✅ 成功记录专家激活: {top_experts}")
+            print(f"  ✅ 成功记录专家激活: layer={layer_idx}, tokens={top_experts.shape[0] * top_experts.shape[1]}")
 
 
 # ========== 模型加载函数 ==========
+def find_router_modules(model_local):
+    """找出输出为路由logits的模块（如Qwen的mlp.gate），返回(模块列表, 专家数)
+
+    专家自身的gate/up/down投影同样命中MoE规则，但输出维度不是专家数，不计入
+    """
+    config = model_local.config
+    num_experts = next(
+        (getattr(config, attr) for attr in ("num_experts", "num_local_experts", "n_routed_experts")
+         if getattr(config, attr, None)),
+        None,
+    )
+    if num_experts is None:
+        return [], None
+
+    routers = []
+    for name, module in model_local.named_modules():
+        if not MOE_MODULE_RE.search(name.rsplit(".", 1)[-1]):
+            continue
+        # 量化后的Linear权重被打包，优先看out_features
+        out_features = getattr(module, "out_features", None)
+        weight = getattr(module, "weight", None)
+        if out_features is None and isinstance(weight, torch.Tensor) and weight.dim() == 2:
+            out_features = weight.shape[0]
+        if out_features == num_experts:
+            routers.append((name, module))
+    return routers, num_experts
+
+def register_expert_hooks(model_local):
+    """优先只在路由模块上注册专家追踪hook，识别不到时按三阶段回退策略注册"""
+    global expert_layer_count, router_logit_dims
+    modules = list(model_local.named_modules())
+    targets, num_experts = find_router_modules(model_local)
+    if targets:
+        # 每个路由模块对应缓冲区的一层，输出中只把末维等于专家数的张量当作logits
+        router_logit_dims = (num_experts,)
+    else:
+        targets = [(name, module) for name, module in modules if MOE_MODULE_RE.search(name)]
+
+    if not targets:
+        if DEBUG_MODE:
+            print("⚠️ 未检测到 MoE 相关模块，尝试回退到 MLP 层 Hook...")
+        targets = [(name, module) for name, module in modules if MLP_MODULE_RE.search(name)]
+
+    if not targets:
+        if DEBUG_MODE:
+            print("⚠️ MLP 也未命中，尝试回退到 Transformer 层（仅注册前5个）")
+        targets = [(name, module) for name, module in modules if LAYER_MODULE_RE.search(name)][:5]
+
+    hook_targets = []
+    for name, module in targets:
+        module.register_forward_hook(partial(detailed_track_experts, layer_idx=len(hook_targets)))
+        hook_targets.append(name)
+
+    expert_layer_count = len(hook_targets)
+
+    if DEBUG_MODE:
+        print(f"✅ 已注册 {len(hook_targets)} 个 Hook 层:")
+        for name in hook_targets[:10]:
+            print(f"  • {name}")
+        if len(hook_targets) > 10:
+            print(f"  ... 还有 {len(hook_targets) - 10} 个未显示")
+
 def check_model_path(path):
     if not os.path.exists(path):
         return False
     required = ['config.json', 'tokenizer.json', 'tokenizer_config.json']
     return all(os.path.exists(os.path.join(path, f)) for f in required)
 
+def build_quantization_config():
+    """MoE解码受显存带宽限制，量化专家权重可成比例减少每个token的读取量"""
+    if QUANTIZE is None:
+        return None
+    from transformers import BitsAndBytesConfig
+    if QUANTIZE == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=select_model_dtype(),
+        bnb_4bit_use_double_quant=True,
+    )
+
+def select_model_dtype():
+    """Ampere及以上GPU使用bf16：指数范围与fp32相同，不易溢出且同样走TensorCore"""
+    if device == "cuda" and torch.cuda.get_device_capability()[0] >= 8:
+        return torch.bfloat16
+    return torch.float16
+
+def select_attn_implementation():
+    """优先使用FlashAttention-2，未安装或不在GPU上时退回PyTorch SDPA融合注意力"""
+    if device == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+        return "flash_attention_2"
+    return "sdpa"
+
 def load_model():
-    global model, tokenizer
+    global model, tokenizer, model_ready
     if not check_model_path(MODEL_PATH):
         raise RuntimeError(f"模型路径不完整: {MODEL_PATH}")
 
-    print("✅ 正在加载模型...")
+    # 残留的fp32矩阵乘允许使用TF32
+    torch.set_float32_matmul_precision("high")
+    print(f"✅ 正在加载模型（注意力实现: {select_attn_implementation()}，精度: {select_model_dtype()}）...")
     model_local = AutoModelForCausalLM.from_pretrained(
         MODEL_PATH,
         device_map="auto",
-        torch_dtype=torch.float16,
+        torch_dtype=select_model_dtype(),
         trust_remote_code=True,
+        quantization_config=build_quantization_config(),
+        attn_implementation=select_attn_implementation(),
     )
 
     tokenizer_local = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
     if tokenizer_local.pad_token is None:
         tokenizer_local.pad_token = tokenizer_local.eos_token
+    # 批量生成时在左侧填充，保证各条prompt的末尾对齐
+    tokenizer_local.padding_side = "left"
 
     # ========== Hook 注册策略 ==========
     # Hook 注册采用三阶段回退策略：
     #   1. 精确注册 MoE / Expert / Router / Gate 层
     #   2. 若失败则尝试所有 MLP 层
     #   3. 最后退化注册前 5 个 Transformer 层
-    hook_targets = []
-
-    for name, module in model_local.named_modules():
-        if any(k in name.lower() for k in ['moe', 'expert', 'router', 'gate']):
-            module.register_forward_hook(detailed_track_experts)
-            hook_targets.append(name)
-
-    if len(hook_targets) == 0:
-        if DEBUG_MODE:
-            print("⚠️ 未检测到 MoE 相关模块，尝试回退到 MLP 层 Hook...")
-        for name, module in model_local.named_modules():
-            if 'mlp' in name.lower():
-                module.register_forward_hook(detailed_track_experts)
-                hook_targets.append(name)
-
-    if len(hook_targets) == 0:
-        if DEBUG_MODE:
-            print("⚠️ MLP 也未命中，尝试回退到 Transformer 层（仅注册前5个）")
-        for name, module in model_local.named_modules():
-            if any(k in name.lower() for k in ['layer', 'block', 'transformer']):
-                if len(hook_targets) < 5:
-                    module.register_forward_hook(detailed_track_experts)
-                    hook_targets.append(name)
-
-    if DEBUG_MODE:
-        print(f"✅ 已注册 {len(hook_targets)} 个 Hook 层:")
-        for name in hook_targets[:10]:
-            print(f"  • {name}")
-        if len(hook_targets) > 10:
-            print(f"  ... 还有 {len(hook_targets) - 10} 个未显示")
+    # 只在调试或开启专家追踪时注册，正常服务时前向过程没有任何hook开销
+    if DEBUG_MODE or TRACE_EXPERTS:
+        register_expert_hooks(model_local)
 
     model_local.eval()
+    # bitsandbytes量化层与torch.compile组合收益很小，量化时不编译
+    compile_layers = COMPILE_MODEL and QUANTIZE is None
+    if COMPILE_MODEL and not compile_layers:
+        print("⚠️ 量化模型不启用torch.compile")
+    if compile_layers:
+        compile_model_layers(model_local)
     model = model_local
     tokenizer = tokenizer_local
 
-# ========== 启动事件 ==========
-@app.on_event("startup")
-def startup_event():
-    load_model()
+    if compile_layers:
+        warmup_model()
+    model_ready = True
+    print("✅ 模型加载完成，开始接收请求")
+
+def compile_model_layers(model_local):
+    """逐个编译结构相同的Transformer块，编译结果在各层间复用，编译耗时远低于整模型编译"""
+    layers = getattr(getattr(model_local, "model", None), "layers", None)
+    if layers is None:
+        print("⚠️ 未找到Transformer层列表，跳过编译")
+        return
+    # 每层及不同输入长度都会产生编译缓存，放宽上限避免回退到eager
+    torch._dynamo.config.cache_size_limit = 64
+    for layer in layers:
+        # MoE路由按专家动态切分token，无法整图编译，允许在此处断图
+        layer.compile(dynamic=True)
+    print(f"✅ 已编译 {len(layers)} 个Transformer层")
+
+def warmup_model():
+    """启动时先生成两次，提前完成JIT编译，避免首个请求承担编译耗时"""
+    inputs = tokenizer(["Hello"], return_tensors="pt").to(device)
+    for _ in range(2):
+        with torch.inference_mode():
+            model.generate(
+                inputs.input_ids,
+                max_new_tokens=8,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+            )
+    print("✅ 模型预热完成")
 
 # ========== 专家信息封装 ==========
-def get_expert_info(max_records: int = 5):
+def get_expert_info(trace, max_records: int = MAX_EXPERT_RECORDS):
     info = {
-        "total_hooks": hook_call_count,
-        "activation_records": len(expert_activations),
+        "total_hooks": trace.hook_call_count,
+        "activation_records": trace.activation_count,
         "details": [],
         "usage": {}
     }
-
-    for i, act in enumerate(expert_activations[:max_records]):
+    if not any(trace.layer_cursors):
+        return info
+
+    # 整个请求只做一次设备到CPU的拷贝
+    steps = min(max(trace.layer_cursors), EXPERT_BUF_TOKENS)
+    buf = trace.buf[:steps].cpu().numpy()
+
+    for record in trace.records[:max_records]:
+        batch, seq_len = record["shape"][0], record["shape"][1]
+        rows = buf[record["start"]:record["start"] + batch * seq_len, record["layer"]]
+        if len(rows) < batch * seq_len:
+            continue  # 该次调用的行已被环形缓冲区截断
         info["details"].append({
-            "module": act["module"],
-            "hook_call": act["hook_call"],
-            "shape": list(act["shape"]),
-            "experts": act["experts"]
+            "module": record["module"],
+            "hook_call": record["hook_call"],
+            "shape": record["shape"],
+            "experts": rows.reshape(batch, -1, 4).tolist()
         })
 
-    usage = defaultdict(int)
-    for record in expert_activations:
-        for batch in record['experts']:
-            for token_experts in batch:
-                for expert_id in token_experts:
-                    usage[expert_id] += 1
-
-    info["usage"] = dict(sorted(usage.items(), key=lambda x: x[1], reverse=True))
+    # 各层有效行拼接后一次bincount，按次数降序输出被激活过的专家
+    all_ids = np.concatenate([
+        buf[:min(count, EXPERT_BUF_TOKENS), layer_idx].ravel()
+        for layer_idx, count in enumerate(trace.layer_cursors)
+    ])
+    counts = np.bincount(all_ids, minlength=getattr(model.config, "num_experts", 0))
+    order = np.argsort(-counts, kind="stable")
+    order = order[counts[order] > 0]
+    info["usage"] = dict(zip(order.tolist(), counts[order].tolist()))
     return info
 
 # ========== 模型结构诊断函数 ==========
 def diagnose_model_structure(model, max_items=20):
-    total_modules = 0
-    moe_related = []
-    module_list = []
-
-    for name, module in model.named_modules():
-        total_modules += 1
-        module_type = type(module).__name__
-        module_list.append((name, module_type))
-        if any(k in name.lower() for k in ['moe', 'expert', 'gate', 'router', 'mlp']):
-            moe_related.append({
-                "name": name,
-                "type": module_type
-            })
+    module_list = [(name, type(module).__name__) for name, module in model.named_modules()]
+    total_modules = len(module_list)
+    moe_related = [
+        {"name": name, "type": module_type}
+        for name, module_type in module_list
+        if MOE_MODULE_RE.search(name) or MLP_MODULE_RE.search(name)
+    ]
     if DEBUG_MODE:
         print(f"�� 模型总模块数: {total_modules}")
         print(f"�� MoE 相关模块数: {len(moe_related)}")
@@ -198,13 +454,172 @@ def diagnose_model_structure(model, max_items=20):
         "moe_related": moe_related
     }
 
+# ========== 前缀KV缓存 ==========
+def cache_nbytes(cache):
+    """KV缓存占用的显存字节数，按底层存储计（crop后的视图仍占着完整存储）"""
+    if hasattr(cache, "layers"):
+        tensors = [t for layer in cache.layers for t in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+    else:
+        tensors = [*cache.key_cache, *cache.value_cache]
+    return sum(t.untyped_storage().nbytes() for t in tensors if isinstance(t, torch.Tensor))
+
+def remove_prefix_entry(key):
+    """从LRU表和前缀树中删除一项，调用方需持有prefix_cache_lock"""
+    global prefix_cache_bytes
+    _, nbytes = prefix_cache.pop(key)
+    prefix_cache_bytes -= nbytes
+    path = [prefix_cache_trie]
+    for token in key:
+        path.append(path[-1][token])
+    del path[-1][None]
+    # 自底向上清理已经没有缓存项的空节点
+    for depth in range(len(key), 0, -1):
+        if path[depth]:
+            break
+        del path[depth - 1][key[depth - 1]]
+
+def acquire_prefix_cache(ids):
+    """取出与ids共享最长前缀的缓存及其长度，未命中返回(None, 0)
+
+    命中的缓存直接交给本次generate原地扩展，期间从缓存表中移除，生成结束后由
+    release_prefix_cache裁剪回前缀长度再放回，全程不需要拷贝
+    """
+    with prefix_cache_lock:
+        node, best_key = prefix_cache_trie, None
+        for token in ids:
+            node = node.get(token)
+            if node is None:
+                break
+            if None in node:
+                best_key = node[None]
+        if best_key is None:
+            return None, 0
+        cache, _ = prefix_cache[best_key]
+        remove_prefix_entry(best_key)
+    return cache, len(best_key)
+
+def release_prefix_cache(ids, cache, discard=False):
+    """generate结束后把缓存裁剪回prompt前缀放回缓存表，超出字节上限时按LRU淘汰
+
+    discard为True（generate失败）时缓存可能只写了一半，直接丢弃；命中的缓存项在
+    acquire时已移出缓存表并扣除了字节数，丢弃后不会留下残余记录
+    """
+    global prefix_cache_bytes
+    if discard:
+        return
+    key = tuple(ids)
+    extra_tokens = cache.get_seq_length() - len(key)
+    if extra_tokens > 0:
+        cache.crop(-extra_tokens)
+    nbytes = cache_nbytes(cache)
+    with prefix_cache_lock:
+        if key in prefix_cache or nbytes > PREFIX_CACHE_MAX_BYTES:
+            return
+        prefix_cache[key] = (cache, nbytes)
+        prefix_cache_bytes += nbytes
+        node = prefix_cache_trie
+        for token in key:
+            node = node.setdefault(token, {})
+        node[None] = key
+        while prefix_cache_bytes > PREFIX_CACHE_MAX_BYTES:
+            remove_prefix_entry(next(iter(prefix_cache)))
+
+def build_prompt_cache(input_ids):
+    """复用最长的已缓存前缀，只对剩余部分做预填充；最后一个token留给generate
+
+    Returns:
+        (DynamicCache, 缓存对应的prompt前缀)，不使用前缀缓存时返回(None, None)
+    """
+    # 命中的前缀不经过前向，追踪专家激活时会漏记这部分token，追踪期间不使用前缀缓存
+    if PREFIX_CACHE_MAX_BYTES <= 0 or expert_layer_count:
+        return None, None
+    ids = input_ids[0].tolist()[:-1]
+    if not ids:
+        return None, None
+    cache, cached_len = acquire_prefix_cache(ids)
+    if cache is None:
+        cache = DynamicCache()
+    if cached_len < len(ids):
+        with torch.inference_mode():
+            model(input_ids[:, cached_len:len(ids)], past_key_values=cache, use_cache=True)
+    return cache, ids
+
 # ========== 推理主函数 ==========
-def chat_generate(prompt_text, temperature=0.7, max_tokens=100, stream=False) -> Union[str, Generator]:
-    inputs = tokenizer([prompt_text], return_tensors="pt").to(device)
+@lru_cache(maxsize=CHAT_TEMPLATE_CACHE_SIZE)
+def encode_chat_prompt(messages_key):
+    """套用对话模板并分词，按(role, content)元组缓存；返回元组，避免缓存内容被修改"""
+    messages = [{"role": role, "content": content} for role, content in messages_key]
+    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tuple(tokenizer(prompt).input_ids)
+
+def to_model_device(tensor):
+    """将输入张量放到模型所在设备，CUDA下经锁页内存异步拷贝"""
+    if model.device.type == "cuda":
+        return tensor.pin_memory().to(model.device, non_blocking=True)
+    return tensor.to(model.device)
+
+def chat_generate(prompt_ids, temperature=0.7, max_tokens=100, stream=False) -> Union[tuple, Generator]:
+    input_ids = to_model_device(torch.tensor([prompt_ids]))
     if stream:
+        # 后台线程执行generate，streamer增量解码，生成一段就推送一段
+        # timeout兜底：生成线程意外卡住时，读取方不会永远阻塞并占着GPU名额
+        streamer = TextIteratorStreamer(
+            tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=STREAM_TOKEN_TIMEOUT
+        )
+        generation_kwargs = dict(
+            inputs=input_ids,
+            streamer=streamer,
+            max_new_tokens=max_tokens,
+            temperature=temperature,
+            do_sample=True,
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            use_cache=True
+        )
+
+        errors = []  # 生成线程中的异常，由token_stream读取后以error事件返回
+
+        def run_generate():
+            cache = prefix_ids = None
+            failed = False
+            try:
+                cache, prefix_ids = build_prompt_cache(input_ids)
+                generation_kwargs["past_key_values"] = cache
+                with torch.inference_mode():
+                    model.generate(**generation_kwargs)
+            except Exception as e:
+                # 生成失败时结束streamer，避免流式响应一直等待
+                print(f"流式生成时发生错误: {e}")
+                errors.append(e)
+                failed = True
+                streamer.end()
+            finally:
+                if cache is not None:
+                    release_prefix_cache(prefix_ids, cache, discard=failed)
+
         def token_stream():
-            generated = model.generate(
-                inputs.input_ids,
+            thread = Thread(target=run_generate, daemon=True)
+            thread.start()
+            try:
+                for text in streamer:
+                    if text:
+                        yield f"data: {text}\n\n"
+            except queue.Empty:
+                errors.append(TimeoutError(f"{STREAM_TOKEN_TIMEOUT}秒内未生成新内容"))
+            else:
+                thread.join()
+            if errors:
+                yield f"event: error\ndata: {errors[0]}\n\n"
+            yield "data: [DONE]\n\n"
+        return token_stream()
+
+    past_key_values, prefix_ids = build_prompt_cache(input_ids)
+    failed = True
+    try:
+        with torch.inference_mode():
+            outputs = model.generate(
+                input_ids,
+                past_key_values=past_key_values,
                 max_new_tokens=max_tokens,
                 temperature=temperature,
                 do_sample=True,
@@ -212,44 +627,165 @@ def chat_generate(prompt_text, temperature=0.7, max_tokens=100, stream=False) ->
                 eos_token_id=tokenizer.eos_token_id,
                 use_cache=True
             )
-            new_tokens = generated[:, inputs.input_ids.shape[1]:]
-            for token_id in new_tokens[0]:
-                text = tokenizer.decode(token_id, skip_special_tokens=True)
-                yield f"data: {text}\n\n"
-            yield "data: [DONE]\n\n"
-        return token_stream()
-
-    with torch.no_grad():
-        outputs = model.generate(
-            inputs.input_ids,
-            max_new_tokens=max_tokens,
-            temperature=temperature,
-            do_sample=True,
-            pad_token_id=tokenizer.pad_token_id,
-            eos_token_id=tokenizer.eos_token_id,
-            use_cache=True
-        )
-    generated_ids = outputs[:, inputs.input_ids.shape[1]:]
-    return tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+        failed = False
+    finally:
+        if past_key_values is not None:
+            release_prefix_cache(prefix_ids, past_key_values, discard=failed)
+    prompt_tokens = input_ids.shape[1]
+    generated_ids = outputs[:, prompt_tokens:]
+    text = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+    # 直接复用已有的token张量计数，无需再对prompt和结果重新编码
+    return text, prompt_tokens, generated_ids.shape[1]
+
+def resolve_max_tokens(max_tokens, prompt_length):
+    """max_tokens为None时按generation_config的默认值换算为该请求的新token数"""
+    if max_tokens is not None:
+        return max_tokens
+    generation_config = model.generation_config
+    if generation_config.max_new_tokens is not None:
+        return generation_config.max_new_tokens
+    # 只配置了max_length时，它包含输入长度；都未配置时generate默认max_length为20
+    max_length = generation_config.max_length or 20
+    return max(max_length - prompt_length, 1)
+
+def batch_generate(prompt_ids_list, temperature, max_tokens_list, traces):
+    """将多个请求合并为一次generate调用，返回各请求的(回复, 输入token数, 生成token数)
+
+    traces为各请求的ExpertTrace，hook只把对应batch行记入其中
+    """
+    # 任一请求的max_tokens为None都会让整组的max()和截取失败，先换算为默认值
+    max_tokens_list = [
+        resolve_max_tokens(max_tokens, len(ids))
+        for max_tokens, ids in zip(max_tokens_list, prompt_ids_list)
+    ]
+    if len(prompt_ids_list) == 1:
+        # 单条请求走chat_generate，可以复用前缀KV缓存
+        token = expert_traces.set((traces, [0], len(prompt_ids_list[0]), None))
+        try:
+            return [chat_generate(prompt_ids_list[0], temperature, max_tokens_list[0])]
+        finally:
+            expert_traces.reset(token)
+
+    inputs = tokenizer.pad({"input_ids": [list(ids) for ids in prompt_ids_list]}, padding=True, return_tensors="pt")
+    input_length = inputs["input_ids"].shape[1]
+    # 追踪专家激活时逐步记录各行是否已结束，避免已结束的行继续写入
+    stopping_criteria = StoppingCriteriaList()
+    active_rows = None
+    if expert_layer_count:
+        tracker = ActiveRowTracker(max_tokens_list, input_length, tokenizer.eos_token_id)
+        stopping_criteria.append(tracker)
+        active_rows = tracker.active_rows
+    # tokenizer为左侧padding，每行前面的padding长度即与最长输入的差
+    token = expert_traces.set(
+        (traces, [input_length - len(ids) for ids in prompt_ids_list], input_length, active_rows)
+    )
+    try:
+        with torch.inference_mode():
+            outputs = model.generate(
+                to_model_device(inputs["input_ids"]),
+                attention_mask=to_model_device(inputs["attention_mask"]),
+                stopping_criteria=stopping_criteria,
+                max_new_tokens=max(max_tokens_list),
+                temperature=temperature,
+                do_sample=True,
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                use_cache=True
+            )
+    finally:
+        expert_traces.reset(token)
+
+    # 按各请求自己的max_tokens截取，结束符之后的填充不计入生成token数
+    results = []
+    for output, ids, max_tokens in zip(outputs, prompt_ids_list, max_tokens_list):
+        new_tokens = output[input_length:input_length + max_tokens]
+        eos_positions = (new_tokens == tokenizer.eos_token_id).nonzero()
+        completion_tokens = int(eos_positions[0]) + 1 if len(eos_positions) else len(new_tokens)
+        text = tokenizer.decode(new_tokens[:completion_tokens], skip_special_tokens=True)
+        results.append((text, len(ids), completion_tokens))
+    return results
+
+async def batch_worker():
+    """从队列收集请求，按temperature分组后批量生成"""
+    while True:
+        batch = [await generate_queue.get()]
+        deadline = time.monotonic() + BATCH_WAIT_SECONDS
+        while len(batch) < BATCH_MAX_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(generate_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # 采样参数不同的请求不能放在同一次generate中
+        groups = defaultdict(list)
+        for item in batch:
+            groups[item[1]].append(item)
+
+        for temperature, items in groups.items():
+            try:
+                # 同批请求共享一次前向，但每个请求只统计自己batch行的专家激活
+                traces = [ExpertTrace() for _ in items]
+                try:
+                    async with gpu_semaphore:
+                        results = await run_in_threadpool(
+                            batch_generate,
+                            [item[0] for item in items],
+                            temperature,
+                            [item[2] for item in items],
+                            traces,
+                        )
+                    expert_infos = [get_expert_info(trace) for trace in traces]
+                finally:
+                    for trace in traces:
+                        trace.release()
+                for item, result, expert_info in zip(items, results, expert_infos):
+                    if not item[3].done():
+                        item[3].set_result((*result, expert_info))
+            except Exception as e:
+                for item in items:
+                    if not item[3].done():
+                        item[3].set_exception(e)
+
+async def submit_generate(prompt_ids, temperature=0.7, max_tokens=100):
+    """提交生成请求，等待批量生成返回(回复, 输入token数, 生成token数, 专家信息)"""
+    future = asyncio.get_running_loop().create_future()
+    await generate_queue.put((prompt_ids, temperature, max_tokens, future))
+    return await future
 
 # ========== Chat API ==========
 @app.post("/v1/chat/completions")
-def chat_completions(req: ChatRequest):
-    global expert_activations, hook_call_count
-    expert_activations.clear()
-    hook_call_count = 0
-
-    messages = [m.dict() for m in req.messages]
-    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+async def chat_completions(req: ChatRequest):
+    if model_load_error is not None:
+        return JSONResponse(status_code=503, content={"error": f"模型加载失败: {model_load_error}"})
+    if not model_ready:
+        return JSONResponse(status_code=503, content={"error": "模型正在加载，请稍后重试"})
+
+    # 相同对话（如共享的system prompt + 历史轮次）直接命中模板分词缓存
+    # 未命中缓存时套用模板和分词较慢，在线程池中执行，不阻塞事件循环
+    prompt_ids = await run_in_threadpool(
+        encode_chat_prompt, tuple((m.role, m.content) for m in req.messages)
+    )
 
     if req.stream:
-        stream = chat_generate(prompt, req.temperature, req.max_tokens, stream=True)
-        return StreamingResponse(stream, media_type="text/event-stream")
-
-    result = chat_generate(prompt, req.temperature, req.max_tokens)
+        stream = chat_generate(prompt_ids, req.temperature, req.max_tokens, stream=True)
+
+        async def guarded_stream():
+            # 整个流式生成期间占用GPU名额，逐块在线程池中取数据，不阻塞事件循环
+            async with gpu_semaphore:
+                async for chunk in iterate_in_threadpool(stream):
+                    yield chunk
+        return StreamingResponse(guarded_stream(), media_type="text/event-stream")
+
+    # 并发请求在短时间窗口内合并为一次generate，在线程池中执行，不阻塞事件循环
+    result, prompt_tokens, completion_tokens, expert_info = await submit_generate(
+        prompt_ids, req.temperature, req.max_tokens
+    )
     response_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
     print(f'响应：{result}')
-    print(get_expert_info())
+    print(expert_info)
 
     return {
         "id": response_id,
@@ -267,21 +803,30 @@ def chat_completions(req: ChatRequest):
             }
         ],
         "usage": {
-            "prompt_tokens": len(tokenizer.encode(prompt)),
-            "completion_tokens": len(tokenizer.encode(result)),
-            "total_tokens": len(tokenizer.encode(prompt)) + len(tokenizer.encode(result))
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
         },
-        "expert_info": get_expert_info()
+        "expert_info": expert_info
     }
 
 # ========== 健康检查 ==========
 @app.get("/health")
 def health():
+    if model_load_error is not None:
+        # 加载失败不会自行恢复，返回503让调用方不再等待
+        return JSONResponse(status_code=503, content={
+            "status": "error",
+            "error": model_load_error,
+            "device": device,
+            "torch_version": torch.__version__,
+            "model_loaded": False
+        })
     return {
-        "status": "ok",
+        "status": "ok" if model_ready else "loading",
         "device": device,
         "torch_version": torch.__version__,
-        "model_loaded": model is not None
+        "model_loaded": model_ready
     }
 
 # ========== 模型结构调试接口 ==========
@@ -328,7 +873,7 @@ async def list_models():
     
 # ========== 命令行启动入口 ==========
 def main():
-    global DEBUG_MODE
+    global DEBUG_MODE, COMPILE_MODEL, TRACE_EXPERTS, PREFIX_CACHE_MAX_BYTES, QUANTIZE
     import uvicorn
     import argparse
 
@@ -336,16 +881,25 @@ def main():
     parser = argparse.ArgumentParser(description="启动 MoE Debug Server")
     parser.add_argument("--debug", action="store_true", help="启用调试模式")
     parser.add_argument("--port", type=int, default=8002, help="设置运行端口，默认为8000")
+    parser.add_argument("--compile", action="store_true", help="用torch.compile编译Transformer层")
+    parser.add_argument("--quantize", choices=["4bit", "8bit"], default=None, help="用bitsandbytes量化加载权重")
+    parser.add_argument("--prefix-cache-mb", type=int, default=PREFIX_CACHE_MAX_BYTES // 2**20, help="前缀KV缓存的显存上限(MB)，默认0表示关闭")
+    parser.add_argument("--trace-experts", action="store_true", help="注册hook追踪专家激活")
     args = parser.parse_args()
 
     DEBUG_MODE = args.debug
+    COMPILE_MODEL = args.compile
+    QUANTIZE = args.quantize
+    TRACE_EXPERTS = args.trace_experts
+    PREFIX_CACHE_MAX_BYTES = args.prefix_cache_mb * 2**20
     port = args.port
 
     print("�� 启动 MoE Debug Server")
     print(f"�� 地址: http://127.0.0.1:{port}")
     print(f"��️  调试模式: {'开启' if DEBUG_MODE else '关闭'}")
 
-    uvicorn.run("moe_server:app", host="0.0.0.0", port=port, reload=False)
+    # 直接传入本文件的app对象，命令行设置的全局参数才会对服务生效
+    uvicorn.run(app, host="0.0.0.0", port=port, reload=False)
 
 
 
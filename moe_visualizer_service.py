@@ -1,8 +1,8 @@
-import json
 import sys
 import threading
 import logging
 
+import numpy as np
 import redis
 
 from show_moe import MoEInterface
@@ -14,11 +14,29 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def decode_expert_counts(data: bytes) -> dict:
+    """
+    还原按专家ID排列的int32激活次数，只保留激活过的专家
+
+    Returns:
+        dict: 格式: {'专家ID': 激活次数}
+    """
+    # 零拷贝还原为数组
+    counts = np.frombuffer(data, dtype="<i4")
+    return {
+        str(expert_id): int(counts[expert_id]) for expert_id in np.flatnonzero(counts)
+    }
+
+
 class MoEVisualizerService:
     """MoE可视化服务 - 独立进程运行"""
 
     def __init__(self, redis_host="localhost", redis_port=6379, redis_db=0):
-        self.redis_client = redis.Redis(host=redis_host, port=redis_port, db=redis_db)
+        # 使用显式连接池，监听线程和其他调用方共享连接
+        self.redis_pool = redis.ConnectionPool(
+            host=redis_host, port=redis_port, db=redis_db, max_connections=32
+        )
+        self.redis_client = redis.Redis(connection_pool=self.redis_pool)
         self.moe_interface = MoEInterface()
         self.visualizer = None
         self.is_running = False
@@ -41,8 +59,7 @@ class MoEVisualizerService:
                 for message in pubsub.listen():
                     if message["type"] == "message":
                         try:
-                            # 解析专家激活数据
-                            expert_data = json.loads(message["data"].decode("utf-8"))
+                            expert_data = decode_expert_counts(message["data"])
                             logger.info(f"收到专家激活数据: {len(expert_data)} 个专家")
 
                             # 更新可视化
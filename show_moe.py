@@ -1,8 +1,10 @@
+import os
 import queue
+import shutil
 import threading
 import time
 import logging
-from typing import Dict
+from typing import Dict, Union
 
 import matplotlib.animation as animation
 import matplotlib.pyplot as plt
@@ -13,26 +15,44 @@ from matplotlib.colors import LinearSegmentedColormap
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 颜色范围变化小于当前最大值的这一比例时沿用旧范围
+CLIM_TOLERANCE = 0.05
+
 
 class MoEExpertVisualizer:
     """MoE专家激活可视化器"""
 
-    def __init__(self, num_experts: int = 64, grid_size: tuple = (8, 8)):
+    def __init__(
+        self,
+        num_experts: int = 64,
+        grid_size: tuple = (8, 8),
+        show_counts: bool = False,
+        figsize: tuple = (16, 10),
+        dpi: int = 100,
+    ):
         """
         初始化可视化器
 
         Args:
             num_experts: 专家数量
             grid_size: 网格大小 (rows, cols)
+            show_counts: 是否在格子中显示激活次数，运行时可按c键切换
+            figsize: 图形尺寸 (宽, 高)，单位英寸
+            dpi: 屏幕显示的分辨率
         """
         self.num_experts = num_experts
         self.grid_size = grid_size
-        self.data_queue = queue.Queue()
-        self.current_data = {}
+        self._show_counts = show_counts
+        self.data_queue = queue.Queue(maxsize=1)  # 只保留最新一份数据
+        # 后台聚合线程算好的待绘制状态，单槽存放，主线程取走后置为None
+        self._render_state = None
+        self._state_lock = threading.Lock()
+        self._aggregator = None
         self.is_running = False
 
         # 初始化图形 - 创建左侧统计面板和右侧热力图
-        self.fig = plt.figure(figsize=(16, 10))
+        # constrained布局在首次绘制时计算，不像tight_layout那样在初始化时额外渲染一遍
+        self.fig = plt.figure(figsize=figsize, dpi=dpi, layout="constrained")
         self.fig.suptitle(
             "MoE Model Expert Activation Real-time Monitor",
             fontsize=18,
@@ -136,6 +156,7 @@ class MoEExpertVisualizer:
                         bbox=dict(
                             boxstyle="round,pad=0.2", facecolor="#cc0000", alpha=0.9
                         ),
+                        visible=show_counts,
                     )
                     count_row.append(count_text)
                 else:
@@ -164,124 +185,262 @@ class MoEExpertVisualizer:
             family="monospace",
         )
 
-        plt.tight_layout()
+        self._prev_grid = np.zeros(grid_size)  # 上一次同步到标签的激活次数
+
+        # 启用blit时只重绘这些会变化的对象，坐标轴、颜色条、专家ID等静态内容缓存为背景
+        self.stats_text.set_animated(True)
+        self.stats_text.set_in_layout(False)  # 统计文本长短变化不影响布局
+        for row in self.activation_count_texts:
+            for count_text in row:
+                if count_text is not None:
+                    count_text.set_animated(True)
+        self._animated_artists = [self.im, self.stats_text] + [
+            count_text
+            for row in self.activation_count_texts
+            for count_text in row
+            if count_text is not None
+        ]
+        self._blit = False
+        self._clim_changed = False
+        self._last_clim = (None, None)  # 上次设置的颜色范围
+        self._last_stats_key = None  # 上次生成统计文本所用的数据
+        self._last_stats_str = ""
+        self.fig.canvas.mpl_connect("key_press_event", self._on_key_press)
+        self._layout_cid = self.fig.canvas.mpl_connect(
+            "draw_event", self._freeze_layout
+        )
+        self.fig.canvas.mpl_connect("resize_event", self._on_resize)
+
+        # 统计面板中固定不变的标题行
+        separator = "━" * 27
+        self._stats_header = f"REAL-TIME STATISTICS\n{separator}"
+        self._top_header = f"TOP 10 MOST ACTIVE EXPERTS:\n{separator}"
+        self._bottom_header = f"TOP 10 LEAST ACTIVE EXPERTS:\n{separator}"
+
+    def _freeze_layout(self, event):
+        """绘制完成后固定布局，之后的整图重绘不再重复计算constrained布局"""
+        self.fig.set_layout_engine("none")
+        self.fig.canvas.mpl_disconnect(self._layout_cid)
+        self._layout_cid = None
+
+    def _on_resize(self, event):
+        """窗口尺寸变化后恢复constrained布局，下一次绘制按新尺寸重新计算后再固定"""
+        if self._layout_cid is None:
+            self.fig.set_layout_engine("constrained")
+            self._layout_cid = self.fig.canvas.mpl_connect(
+                "draw_event", self._freeze_layout
+            )
 
-    def update_expert_data(self, expert_stats: Dict[str, int]) -> None:
+    def update_expert_data(
+        self, expert_stats: Union[Dict[str, int], np.ndarray]
+    ) -> None:
         """
         更新专家激活数据的接口方法
 
         Args:
-            expert_stats: 专家统计数据，格式: {'专家ID': 激活次数}
+            expert_stats: 专家统计数据，格式: {'专家ID': 激活次数}，
+                或按专家ID排列的激活次数数组（长度通常为num_experts）
+
+        Note:
+            队列只保留最新一份数据，显示跟不上时直接丢弃旧数据。
+            数据在这里一次性转换为数组，逐token更新时建议直接传数组
         """
         try:
-            # 将数据放入队列
-            self.data_queue.put(expert_stats.copy())
+            if isinstance(expert_stats, np.ndarray):
+                # 数组下标即专家ID，复制一份以免调用方复用缓冲区
+                counts = np.array(expert_stats, dtype=np.int64).ravel()
+                ids = np.arange(counts.size)
+            else:
+                ids = np.fromiter(
+                    map(int, expert_stats.keys()),
+                    dtype=np.int64,
+                    count=len(expert_stats),
+                )
+                counts = np.fromiter(
+                    expert_stats.values(), dtype=np.int64, count=len(expert_stats)
+                )
+            # 队列已满时先取出旧数据再放入，最新数据优先
+            while True:
+                try:
+                    self.data_queue.put_nowait((ids, counts))
+                    break
+                except queue.Full:
+                    try:
+                        self.data_queue.get_nowait()
+                    except queue.Empty:
+                        pass
             logger.info(
-                f"Data updated: Received activation data for {len(expert_stats)} experts"
+                f"Data updated: Received activation data for {len(counts)} experts"
             )
         except Exception as e:
             logger.error(f"Error updating data: {e}")
 
-    def _process_data_queue(self):
-        """处理数据队列中的数据"""
+    def _aggregate_loop(self):
+        """后台聚合线程：取最新数据算好网格和统计文本，放入单槽等待主线程绘制"""
+        while self.is_running:
+            try:
+                ids, counts = self.data_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                state = self._compute_render_state(ids, counts)
+            except Exception as e:
+                logger.error(f"Error aggregating data: {e}")
+                continue
+            if state is not None:
+                with self._state_lock:
+                    self._render_state = state
+
+    def _take_render_state(self):
+        """取出待绘制状态；没有后台聚合线程时（如保存动画）直接在当前线程计算"""
+        if self._aggregator is not None and self._aggregator.is_alive():
+            with self._state_lock:
+                state, self._render_state = self._render_state, None
+            return state
+
         try:
-            while not self.data_queue.empty():
-                new_data = self.data_queue.get_nowait()
-                self.current_data = new_data
+            ids, counts = self.data_queue.get_nowait()
         except queue.Empty:
-            pass
-
-    def _update_grid(self):
-        """更新显示网格"""
-        if not self.current_data:
+            return None
+        return self._compute_render_state(ids, counts)
+
+    def _update_count_texts(self):
+        """同步格子中的激活次数标签"""
+        # 只重设激活次数有变化的格子，本帧没有数据的专家在网格中为0
+        cols = self.grid_size[1]
+        for flat_idx in np.flatnonzero(self.expert_grid != self._prev_grid):
+            count_text = self.activation_count_texts[flat_idx // cols][flat_idx % cols]
+            if count_text is not None:
+                count_text.set_text(str(int(self.expert_grid.flat[flat_idx])))
+        self._prev_grid[...] = self.expert_grid
+
+    def _on_key_press(self, event):
+        """按c键显示/隐藏格子中的激活次数"""
+        if event.key != "c":
             return
+        self._show_counts = not self._show_counts
+        if self._show_counts:
+            # 隐藏期间标签停留在隐藏前的内容，_prev_grid也未更新，直接按差异同步
+            self._update_count_texts()
+        for row in self.activation_count_texts:
+            for count_text in row:
+                if count_text is not None:
+                    count_text.set_visible(self._show_counts)
 
-        # 重置网格
-        self.expert_grid.fill(0)
-
-        # 更新专家激活数据
-        max_activation = max(self.current_data.values()) if self.current_data else 1
-        min_activation = min(self.current_data.values()) if self.current_data else 0
-
-        for i in range(self.grid_size[0]):
-            for j in range(self.grid_size[1]):
-                expert_id = self.expert_ids[i, j]
-                if expert_id < self.num_experts:
-                    expert_key = str(expert_id)
-                    if expert_key in self.current_data:
-                        activation_count = self.current_data[expert_key]
-                        self.expert_grid[i, j] = activation_count
-
-                        # 更新中间的激活次数显示
-                        if self.activation_count_texts[i][j] is not None:
-                            self.activation_count_texts[i][j].set_text(
-                                str(activation_count)
-                            )
-                    else:
-                        # 如果没有数据，显示0
-                        if self.activation_count_texts[i][j] is not None:
-                            self.activation_count_texts[i][j].set_text("0")
-
-        # 更新颜色映射范围
-        if max_activation > 0:
-            self.im.set_clim(vmin=min_activation, vmax=max_activation)
-
-        # 更新图像数据
-        self.im.set_array(self.expert_grid)
+    def _compute_render_state(self, ids: np.ndarray, counts: np.ndarray):
+        """
+        根据一份激活数据计算网格、颜色范围和统计文本，不调用matplotlib
 
-        # 更新统计信息
-        if self.current_data:
-            total_activations = sum(self.current_data.values())
-            active_experts = len([v for v in self.current_data.values() if v > 0])
-            avg_activation = (
-                total_activations / len(self.current_data) if self.current_data else 0
+        Returns:
+            dict: 待绘制状态，没有数据时返回None
+        """
+        if counts.size == 0:
+            return None
+
+        # expert_ids按行优先排列，专家ID即网格的展平下标
+        grid = np.zeros(self.grid_size)
+        valid = (ids >= 0) & (ids < self.num_experts)
+        grid.flat[ids[valid]] = counts[valid]
+
+        # 统计信息
+        total_activations = int(counts.sum())
+        active_experts = int(np.count_nonzero(counts > 0))
+        avg_activation = total_activations / len(counts)
+
+        # 取前10多和前10少，只对选出的10个排序；激活次数相同时靠前的专家优先，
+        # 组合成唯一的键后argpartition选出的集合与完整稳定排序一致
+        n = len(counts)
+        k = min(10, n)
+        order_key = counts * n - np.arange(n)
+        if n > k:
+            top_idx = np.argpartition(-order_key, k - 1)[:k]
+            bottom_idx = np.argpartition(order_key, k - 1)[:k]
+        else:
+            top_idx = bottom_idx = np.arange(n)
+        top_idx = top_idx[np.argsort(-order_key[top_idx])]
+        bottom_idx = bottom_idx[np.argsort(-order_key[bottom_idx])]
+        top_10 = [(int(ids[i]), int(counts[i])) for i in top_idx]
+        bottom_10 = [(int(ids[i]), int(counts[i])) for i in bottom_idx]
+
+        # 统计面板显示的内容都没变时沿用上次的文本
+        stats_key = (
+            total_activations,
+            active_experts,
+            n,
+            tuple(top_10),
+            tuple(bottom_10),
+        )
+        if stats_key != self._last_stats_key:
+            # 固定的标题行在初始化时已生成
+            stats_lines = [
+                self._stats_header,
+                f"Total Activations: {total_activations:,}",
+                f"Active Experts: {active_experts}/{self.num_experts}",
+                f"Average Activation: {avg_activation:.1f}",
+                "",
+                self._top_header,
+            ]
+            stats_lines.extend(
+                f"{i:2d}. Expert {expert_id:<2d}: {count:,}"
+                for i, (expert_id, count) in enumerate(top_10, 1)
             )
-
-            # 按激活次数排序获取前10多和前10少
-            sorted_experts = sorted(
-                self.current_data.items(), key=lambda x: x[1], reverse=True
+            stats_lines.extend(["", self._bottom_header])
+            stats_lines.extend(
+                f"{i:2d}. Expert {expert_id:<2d}: {count:,}"
+                for i, (expert_id, count) in enumerate(bottom_10, 1)
             )
-            top_10 = sorted_experts[:10]
-            bottom_10 = sorted_experts[-10:]
-
-            # 生成统计文本
-            stats_text = f"""REAL-TIME STATISTICS
-━━━━━━━━━━━━━━━━━━━━━━━━━━━
-Total Activations: {total_activations:,}
-Active Experts: {active_experts}/{self.num_experts}
-Average Activation: {avg_activation:.1f}
-
-TOP 10 MOST ACTIVE EXPERTS:
-━━━━━━━━━━━━━━━━━━━━━━━━━━━"""
-
-            for i, (expert_id, count) in enumerate(top_10, 1):
-                stats_text += f"\n{i:2d}. Expert {expert_id:2s}: {count:,}"
-
-            stats_text += f"""
-
-TOP 10 LEAST ACTIVE EXPERTS:
-━━━━━━━━━━━━━━━━━━━━━━━━━━━"""
-
-            for i, (expert_id, count) in enumerate(bottom_10, 1):
-                stats_text += f"\n{i:2d}. Expert {expert_id:2s}: {count:,}"
-
-            self.stats_text.set_text(stats_text)
+            self._last_stats_key = stats_key
+            self._last_stats_str = "\n".join(stats_lines)
+
+        return {
+            "grid": grid,
+            "min": int(counts.min()),
+            "max": int(counts.max()),
+            "stats": self._last_stats_str,
+        }
+
+    def _apply_render_state(self, state: dict) -> None:
+        """把算好的状态写入图形对象，只在主线程调用"""
+        self.expert_grid = state["grid"]
+        max_activation = state["max"]
+        min_activation = state["min"]
+
+        # 64个文本标签是绘制开销的大头，隐藏时完全跳过
+        if self._show_counts:
+            self._update_count_texts()
+
+        # 更新颜色映射范围：变化超过当前最大值的5%才重设，避免每帧重算颜色映射和整图重绘
+        if max_activation > 0:
+            last_vmin, last_vmax = self._last_clim
+            tolerance = CLIM_TOLERANCE * max_activation
+            if (
+                last_vmax is None
+                or abs(max_activation - last_vmax) > tolerance
+                or abs(min_activation - last_vmin) > tolerance
+            ):
+                self.im.set_clim(vmin=min_activation, vmax=max_activation)
+                self._last_clim = (min_activation, max_activation)
+                self._clim_changed = True
+
+        # 更新图像数据和统计信息，文本相同时set_text不会触发重新排版
+        self.im.set_array(self.expert_grid)
+        self.stats_text.set_text(state["stats"])
 
     def animate(self, frame):
         """动画更新函数"""
-        self._process_data_queue()
-        self._update_grid()
-
-        # 返回所有需要更新的对象
-        update_objects = [self.im, self.stats_text]
+        # 没有新数据时跳过所有更新
+        state = self._take_render_state()
+        if state is not None:
+            self._apply_render_state(state)
 
-        # 添加所有激活次数文本对象到更新列表
-        for row in self.activation_count_texts:
-            for text_obj in row:
-                if text_obj is not None:
-                    update_objects.append(text_obj)
+        # 颜色条不在blit范围内，颜色范围变化时整图重绘一次，随后再blit动态对象
+        if self._clim_changed:
+            self._clim_changed = False
+            if self._blit:
+                self.fig.canvas.draw()
 
-        return update_objects
+        # blit会先恢复背景再重画返回的对象，空闲帧也要返回全部动态对象，否则它们会被擦掉
+        return self._animated_artists
 
     def start_animation(self, interval: int = 1000):
         """
@@ -291,11 +450,16 @@ TOP 10 LEAST ACTIVE EXPERTS:
             interval: 动画更新间隔(毫秒)
         """
         self.is_running = True
+        # 数据聚合放到后台线程，主线程的动画回调只做绘制
+        self._aggregator = threading.Thread(target=self._aggregate_loop, daemon=True)
+        self._aggregator.start()
+        # 不支持blit的后端（如macOS）上FuncAnimation会自动退回整图重绘
+        self._blit = self.fig.canvas.supports_blit
         self.ani = animation.FuncAnimation(
             self.fig,
             self.animate,
             interval=interval,
-            blit=False,
+            blit=True,
             repeat=True,
             cache_frame_data=False,
         )
@@ -307,27 +471,52 @@ TOP 10 LEAST ACTIVE EXPERTS:
         if hasattr(self, "ani"):
             self.ani.event_source.stop()
 
-    def save_animation(self, filename: str, duration: int = 10, fps: int = 2):
+    def save_animation(
+        self, filename: str, duration: int = 10, fps: int = 2, dpi: int = 72
+    ) -> str:
         """
-        保存动画为GIF文件
+        保存动画，有FFmpeg时编码为H.264 MP4，否则退回GIF
 
         Args:
-            filename: 文件名
+            filename: 文件名，扩展名按实际使用的格式自动改为.mp4或.gif
             duration: 动画时长(秒)
             fps: 帧率
+            dpi: 保存分辨率，渲染和编码耗时大致与像素数成正比，默认低于屏幕显示
+
+        Returns:
+            str: 实际保存的文件名
         """
+        stem, ext = os.path.splitext(filename)
+        if shutil.which("ffmpeg"):
+            # MP4编码远快于GIF，文件也小得多
+            if ext.lower() not in (".mp4", ".mov"):
+                filename = stem + ".mp4"
+            # codec为h264时matplotlib会自动补上yuv420p像素格式，并把帧尺寸调整为偶数
+            writer = animation.FFMpegWriter(
+                fps=fps,
+                codec="h264",
+                bitrate=-1,
+                extra_args=["-preset", "veryfast"],
+            )
+        else:
+            if ext.lower() != ".gif":
+                filename = stem + ".gif"
+            writer = animation.PillowWriter(fps=fps)
+
         logger.info(f"Saving animation to {filename}...")
         frames = duration * fps
+        self._blit = False  # 保存时每帧都整图渲染
         self.ani = animation.FuncAnimation(
             self.fig,
             self.animate,
             frames=frames,
             interval=1000 // fps,
-            blit=False,
+            blit=True,
             repeat=False,
         )
-        self.ani.save(filename, writer="pillow", fps=fps)
+        self.ani.save(filename, writer=writer, dpi=dpi)
         logger.info(f"Animation saved to {filename}")
+        return filename
 
 
 def simulate_moe_conversation(visualizer: MoEExpertVisualizer):
@@ -482,25 +671,21 @@ def simulate_moe_conversation(visualizer: MoEExpertVisualizer):
 
         # 继续生成随机变化的数据来模拟持续对话
         logger.info("\n=== Starting Continuous Conversation Simulation ===")
-        base_data = expert_data_2.copy()
+        rng = np.random.default_rng()
+        base_values = np.array(
+            [expert_data_2.get(str(i), rng.integers(100, 300)) for i in range(64)],
+            dtype=np.int64,
+        )
+        expert_keys = [str(i) for i in range(64)]
 
         for round_num in range(3, 20):
-            # 随机调整专家激活数据
-            new_data = {}
-            for expert_id in range(64):
-                expert_key = str(expert_id)
-                if expert_key in base_data:
-                    # 在原值基础上随机变化 ±50
-                    base_value = base_data[expert_key]
-                    change = np.random.randint(-50, 51)
-                    new_value = max(100, base_value + change)  # 最小值100
-                    new_data[expert_key] = new_value
-                else:
-                    new_data[expert_key] = np.random.randint(100, 300)
+            # 在原值基础上随机变化 ±50，最小值100；一次生成全部专家的变化量
+            changes = rng.integers(-50, 51, size=64)
+            base_values = np.maximum(100, base_values + changes)
+            new_data = dict(zip(expert_keys, base_values.tolist()))
 
             logger.info(f"Round {round_num} conversation data generated")
             visualizer.update_expert_data(new_data)
-            base_data = new_data.copy()
             time.sleep(3)  # 每3秒更新一次
 
     # 启动数据输入线程
@@ -543,12 +728,13 @@ class MoEInterface:
         self.visualizer = MoEExpertVisualizer(num_experts=num_experts)
         return self.visualizer
 
-    def update_expert_activation(self, expert_stats: Dict[str, int]):
+    def update_expert_activation(self, expert_stats: Union[Dict[str, int], np.ndarray]):
         """
         外部程序调用此方法更新专家激活数据
 
         Args:
-            expert_stats: 专家激活统计，格式: {'专家ID': 激活次数}
+            expert_stats: 专家激活统计，格式: {'专家ID': 激活次数}，
+                或按专家ID排列的激活次数数组
 
         Example:
             interface = MoEInterface()